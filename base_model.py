@@ -3,26 +3,53 @@ import torch
 import numpy as np
 import time
 import os
+import contextlib
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from torch.optim import SparseAdam
 from torch.optim import Adam
 from torch import optim
 from torch.optim.lr_scheduler import ExponentialLR, ReduceLROnPlateau
 from models import GNNModel
+from kg_index import frontier_cost
 from utils import *
 from tqdm import tqdm
-from torch.cuda.amp import GradScaler, autocast
+from torch.cuda.amp import GradScaler
 # import networkx as nx
 # import matplotlib.pyplot as plt
 
-# Initialize the gradient scaler
-scaler = GradScaler()
+
+class TrainLoss(torch.nn.Module):
+    # training forward and loss of the GNNModel as one module, so that DistributedDataParallel
+    # finds the parameters each batch used from the loss tensors it returns
+    def __init__(self, model, sparse_scores, amp, amp_dtype):
+        super(TrainLoss, self).__init__()
+        self.model = model
+        self.sparse_scores = sparse_scores
+        self.amp = amp
+        self.amp_dtype = amp_dtype
+
+    def forward(self, subs, rels, objs):
+        # objs: [B] LongTensor of the answers, returns the loss of the batch and the N3 term
+        with torch.autocast(objs.device.type, dtype=self.amp_dtype, enabled=self.amp):
+            scores,l = self.model(subs, rels, sparse=self.sparse_scores)
+        # scores and the N3 term come back in fp32, the loss is computed outside autocast
+        if self.sparse_scores:
+            # same loss from the visited scores, unvisited entities folded in analytically
+            # the dense loss below broadcasts [B] against [B, 1] and so sums the batch loss B times; keep that scale
+            return len(objs) * scores.cross_entropy(objs), l
+        pos_scores = scores[[torch.arange(len(scores), device=objs.device), objs]]
+        max_n = torch.max(scores, 1, keepdim=True)[0]
+        loss = torch.sum(- pos_scores + max_n + torch.log(torch.sum(torch.exp(scores - max_n),1)))
+        return loss, l
 
 
 class BaseModel(object):
     def __init__(self, args, loader):
+        self.device = get_device(args)
         self.model = GNNModel(args, loader)
         # self.model = torch.nn.DataParallel(self.model, device_ids=[0, 1])
-        self.model.cuda()
+        self.model.to(self.device)
         self.loader = loader
         self.n_ent = loader.n_ent
         self.n_rel = loader.n_rel
@@ -33,6 +60,23 @@ class BaseModel(object):
         self.n_test  = loader.n_test
         self.n_layer = args.n_layer
         self.args = args
+        # keep batch scores as SparseScores of the visited nodes instead of dense [B, n_ent] matrices
+        self.sparse_scores = getattr(args, 'sparse_scores', False)
+        # mixed precision training: fp16 autocast with loss scaling on gpu, bf16 autocast on cpu
+        self.amp = getattr(args, 'amp', False)
+        self.amp_dtype = torch.float16 if self.device.type == 'cuda' else torch.bfloat16
+        self.scaler = GradScaler(enabled=self.amp and self.device.type == 'cuda')
+        self.health = NumericalHealth(self.model, policy=getattr(args, 'nan_policy', 'skip'),
+                                      snapshot_interval=getattr(args, 'snapshot_interval', 100))
+        # data parallel training when started by train.py with --world_size > 1: every rank trains on
+        # its share of each step and DistributedDataParallel averages the gradients
+        self.rank = dist.get_rank() if dist.is_initialized() else 0
+        self.world_size = dist.get_world_size() if dist.is_initialized() else 1
+        self.train_step = TrainLoss(self.model, self.sparse_scores, self.amp, self.amp_dtype)
+        if self.world_size > 1:
+            # W_o / Wo_attn and pruned layers get no gradient
+            self.train_step = DistributedDataParallel(self.train_step, find_unused_parameters=True,
+                                                      device_ids=[self.device] if self.device.type == 'cuda' else None)
         if args.optimizer == 'Adam':
             self.optimizer = Adam(self.model.parameters(), lr=args.lr, weight_decay=args.lamb)
             # self.optimizer = SparseAdam(self.model.parameters(), lr=args.lr)
@@ -44,7 +88,11 @@ class BaseModel(object):
         else:
             raise NotImplementedError(f'==> [Error] {self.scheduler} scheduler is not supported yet.')
         
+        # model selection on a fixed relation-stratified subset of --val_sample validation queries
+        if getattr(args, 'val_sample', 0) > 0:
+            self.val_subset = stratified_sample(loader.valid_q[:, 1], args.val_sample, seed=getattr(args, 'seed', 0))
         self.t_time = 0
+        self.t_wait = 0
         self.lastSaveGNNPath = None
         self.modelName = f'{args.n_layer}-layers'
         # for i in range(args.n_layer):
@@ -78,7 +126,7 @@ class BaseModel(object):
     def loadModel(self, filePath, layers=-1):
         print(f'Load weight from {filePath}')
         assert os.path.exists(filePath)
-        checkpoint = torch.load(filePath, map_location=torch.device(f'cuda:{self.args.gpu}'))
+        checkpoint = torch.load(filePath, map_location=self.device)
         if layers != -1:
             extra_layers = self.model.gnn_layers[layers:]
             self.model.gnn_layers = self.model.gnn_layers[:layers]
@@ -99,38 +147,67 @@ class BaseModel(object):
         epoch_loss = 0
         i = 0
         batch_size = self.n_batch
-        n_batch = self.loader.n_train // batch_size + (self.loader.n_train % batch_size > 0)
         t_time = time.time()
         self.model.train()
-        
-        for i in tqdm(range(n_batch), position=0):
-            start = i*batch_size
-            end = min(self.loader.n_train, (i+1)*batch_size)
-            batch_idx = np.arange(start, end)
-            triple = self.loader.get_batch(batch_idx)
-
-            self.model.zero_grad()
-
 
-            scores,l = self.model(triple[:,0], triple[:,1])
-            pos_scores = scores[[torch.arange(len(scores)).cuda(), torch.LongTensor(triple[:,2]).cuda()]]
-            max_n = torch.max(scores, 1, keepdim=True)[0]
-            loss = torch.sum(- pos_scores + max_n + torch.log(torch.sum(torch.exp(scores - max_n),1))) + l
+        # micro-batches of queries whose estimated edge count fills --edge_budget, accumulated into optimizer
+        # steps of at least batch_size queries (steps of batch_size queries, one micro-batch each, when it is 0)
+        budget = getattr(self.args, 'edge_budget', 0)
+        costs = np.zeros(self.loader.n_train)
+        if budget > 0:
+            costs = frontier_cost(self.loader.KG, self.loader.KG_offsets, self.loader.train_data[:, 0],
+                                  [layer.n_node_topk for layer in self.model.gnn_layers])
+        # every rank takes its share of each step, the loader shuffles alike on all ranks
+        micro_batches = [(batch_idx, step_size, j == len(step) - 1)
+                         for step_size, step in pack_batches(costs, batch_size, budget, self.rank, self.world_size)
+                         for j, batch_idx in enumerate(step)]
 
+        def make_batch(i):
+            batch_idx, step_size, last = micro_batches[i]
+            return self.loader.get_batch(batch_idx), step_size, last
 
-            loss.backward()
-            self.optimizer.step()
+        batches = self.prefetcher(make_batch, range(len(micro_batches)))
+        self.model.zero_grad()
+        step_loss = 0
+        for triple, step_size, last in tqdm(batches, total=batches.total, position=0, disable=self.rank > 0):
+            # gradients are all-reduced once per step, on its last micro-batch
+            sync = self.world_size == 1 or last
+            with contextlib.nullcontext() if sync else self.train_step.no_sync():
+                loss, l = self.train_step(triple[:,0], triple[:,1], torch.LongTensor(triple[:,2]).to(self.device))
+                # the loss of a step is normalized to its effective batch n = min(batch_size, step_size): the mean
+                # over the step times n * n, the scale of the dense loss of one batch of n queries; the N3 term
+                # is averaged over the micro-batches. With --edge_budget 0 this is the loss of one batch
+                n = min(batch_size, step_size)
+                loss = loss * (n * n / (step_size * len(triple))) + l * (len(triple) / step_size)
+                # DistributedDataParallel averages the gradients over the ranks, they should sum
+                self.scaler.scale(loss * self.world_size).backward()
+            step_loss = step_loss + loss.detach()
+            if not last:
+                continue
+            self.scaler.unscale_(self.optimizer)
+            if self.world_size > 1:
+                # the loss of the whole step, so every rank takes the same --nan_policy decision
+                dist.all_reduce(step_loss)
 
-            # avoid NaN
-            for p in self.model.parameters():#
-                X = p.data.clone()
-                flag = X != X
-                X[flag] = np.random.random()
-                p.data.copy_(X)
-            epoch_loss += loss.item()
-            torch.cuda.empty_cache()
+            # avoid NaN: one fused check of the loss and gradients, non-finite steps handled by --nan_policy
+            # gradient overflows of the loss scale stay with the scaler, whose step skips them
+            healthy, loss_value = self.health.check(step_loss, scaled=self.scaler.is_enabled())
+            if healthy:
+                self.scaler.step(self.optimizer)
+                self.health.stepped(self.optimizer)
+            elif self.health.handle(self.optimizer):
+                # repaired gradients: the scaler would skip the step for the infs it found in unscale_,
+                # its update() below still lowers the scale
+                self.optimizer.step()
+                self.health.stepped(self.optimizer)
+            self.scaler.update()
+            if healthy:
+                epoch_loss += loss_value
+            self.model.zero_grad()
+            step_loss = 0
 
         self.t_time += time.time() - t_time
+        self.t_wait += batches.wait_time
 
         if self.args.scheduler == 'exp':
             self.scheduler.step()
@@ -139,86 +216,171 @@ class BaseModel(object):
 
         return epoch_loss
 
+    def prefetcher(self, make_batch, indices):
+        return BatchPrefetcher(make_batch, indices,
+                               depth=getattr(self.args, 'prefetch', 2),
+                               workers=getattr(self.args, 'prefetch_workers', 1))
+
+    def eval_batch_maker(self, data):
+        # queries, answers and the (rows, cols) of the known answers of a valid/test batch, built off the main thread
+        filters_csr = self.loader.valid_filters if data == 'valid' else self.loader.test_filters
+
+        def make_batch(batch_idx):
+            subs, rels, objs, nums = self.loader.get_batch(batch_idx, data=data)
+            return batch_idx, subs, rels, objs, nums, filters_csr.gather(batch_idx)
+
+        return make_batch
+
+    def eval_bytes(self, edges, n_query):
+        # bytes of a no_grad forward and its ranking: the edges it expands (int64 edge rows, messages,
+        # attention) and the score rows of its queries with the ranking temporaries
+        edge_bytes = 8 * 6 + 4 * (4 * self.args.hidden_dim + self.args.attn_dim)
+        score_bytes = 0 if self.sparse_scores else 13 * self.n_ent
+        return edges * edge_bytes + n_query * score_bytes
+
+    def eval_costs(self, data):
+        # estimated bytes of every valid/test query, from its estimated frontier
+        query = self.loader.valid_q if data == 'valid' else self.loader.test_q
+        edges = frontier_cost(self.loader.tKG, self.loader.tKG_offsets, query[:, 0],
+                              [layer.n_node_topk for layer in self.model.gnn_layers])
+        return self.eval_bytes(edges, 1)
+
+    def score_batch(self, data, batch, make_batch, batcher):
+        # scores a prepared batch; with a batcher, its peak memory is measured and on running out of
+        # memory the batch is retried in halves. returns a list of (batch, scores)
+        batch_idx, subs, rels = batch[:3]
+        measure = batcher is not None and self.device.type == 'cuda'
+        if measure:
+            allocated = torch.cuda.memory_allocated(self.device)
+            torch.cuda.reset_peak_memory_stats(self.device)
+        scores = None
+        try:
+            scores = self.model(subs, rels, mode=data, sparse=self.sparse_scores)
+        except (RuntimeError, MemoryError) as e:
+            if batcher is None or len(batch_idx) == 1 or not is_out_of_memory(e):
+                raise
+        if scores is None:
+            # retried outside the except block, so that the failed forward has released its memory
+            if self.device.type == 'cuda':
+                torch.cuda.empty_cache()
+            batcher.backoff(batch_idx)
+            return [scored for half in np.array_split(batch_idx, 2)
+                    for scored in self.score_batch(data, make_batch(half), make_batch, batcher)]
+        if self.device.type == 'cuda':
+            # the forward is timed on its own, not inside the ranking that would wait for it
+            torch.cuda.synchronize(self.device)
+        if measure:
+            batcher.observe(batch_idx, torch.cuda.max_memory_allocated(self.device) - allocated)
+        elif batcher is not None:
+            # no allocator statistics on cpu: the bytes of the edges the forward actually expanded
+            batcher.observe(batch_idx, self.eval_bytes(self.model.n_edges, len(batch_idx)))
+        return [(batch, scores)]
+
+    def rank_batch(self, scores, objs, filters):
+        if self.sparse_scores:
+            return cal_ranks_sparse(scores.numpy(), objs, filters, scores.n_query, self.n_ent)
+        # scores: [batch_size, n_ent] on the model device, objs / filters: (rows, cols) of the answers / known answers
+        # ranked where the scores are, only the ranks come back to host
+        return list(count_ranks(scores, objs, filters))
+
+    def predict(self, subs, rels, k=10):
+        # [len(subs), k] top tail entities and their scores for the queries (subs, rels)
+        self.model.eval()
+        with torch.no_grad():
+            scores = self.model(subs, rels, mode='test', sparse=True)
+        return scores.topk(k)
+
+    def eval_split(self, data, verbose=True, indices=None):
+        # streams the valid/test queries (all, or the given indices): batches are prepared ahead, and ranked
+        # in background threads while the model scores the next batch
+        # returns the ranks, the answers per query and the time breakdown
+        if indices is None:
+            indices = np.arange(self.n_valid if data == 'valid' else self.n_test)
+        make_batch = self.eval_batch_maker(data)
+        # batches of n_tbatch queries, or sized to --eval_budget MB of memory
+        budget = getattr(self.args, 'eval_budget', 0) * 2 ** 20
+        batcher = AdaptiveBatcher(self.eval_costs(data), budget) if budget > 0 else None
+        if batcher is None:
+            batch_indices = [indices[i:i + self.n_tbatch] for i in range(0, len(indices), self.n_tbatch)]
+        else:
+            batch_indices = batcher.batches(indices)
+        batches = self.prefetcher(make_batch, batch_indices)
+        iterator = tqdm(batches, total=batches.total, position=0) if verbose else batches
+        forward_time = 0
+        n_batch = 0
+        num = []
+        with RankPipeline(self.rank_batch, depth=getattr(self.args, 'prefetch', 2),
+                          workers=getattr(self.args, 'prefetch_workers', 1)) as ranker:
+            for batch in iterator:
+                t = time.time()
+                scored = self.score_batch(data, batch, make_batch, batcher)
+                forward_time += time.time() - t
+                for (_, _, _, objs, nums, filters), scores in scored:
+                    num += nums
+                    ranker.submit(scores, objs, filters)
+                n_batch += len(scored)
+            ranking = ranker.result()
+        timing = {'forward': forward_time, 'rank': ranker.rank_time,
+                  'wait': batches.wait_time + ranker.wait_time,
+                  'queries': len(indices), 'batches': n_batch,
+                  'backoffs': batcher.backoffs if batcher is not None else 0}
+        return ranking, num, timing
+
+    def evaluate_sample(self, verbose=False):
+        # validation on the --val_sample subset: MRR and Hits with --val_confidence bootstrap intervals
+        self.model.eval()
+        i_time = time.time()
+        with torch.no_grad():
+            ranking, num, timing = self.eval_split('valid', verbose, self.val_subset)
+        point, low, high = bootstrap_metrics(ranking, np.concatenate([[0], np.cumsum(num)]),
+                                             self.loader.valid_q[self.val_subset, 1],
+                                             n_boot=getattr(self.args, 'bootstrap', 1000),
+                                             confidence=getattr(self.args, 'val_confidence', 0.95),
+                                             seed=getattr(self.args, 'seed', 0))
+        i_time = time.time() - i_time
+        result_dict = {}
+        for name, p, lo, hi in zip(['mrr', 'h1', 'h3', 'h10', 'h50'], point, low, high):
+            result_dict['v_' + name], result_dict['v_%s_low' % name], result_dict['v_%s_high' % name] = p, lo, hi
+        out_str = ('[VALID-SAMPLE] queries:%d MRR:%.4f [%.4f, %.4f] H@1:%.4f [%.4f, %.4f] H@3:%.4f [%.4f, %.4f] '
+                   'H@10:%.4f [%.4f, %.4f]\t H@50:%.4f [%.4f, %.4f]\t[TIME] inference:%.4f forward:%.4f rank:%.4f\n'
+                   % ((len(self.val_subset),) + tuple(np.stack([point, low, high], 1).ravel())
+                      + (i_time, timing['forward'], timing['rank'])))
+        return result_dict, out_str
+
     def evaluate(self, verbose=True, eval_val=True, eval_test=False, inference_path=False,writer_flag=False):
-        batch_size = self.n_tbatch
-        n_data = self.n_valid
-        n_batch = n_data // batch_size + (n_data % batch_size > 0)
-        ranking = []
         self.model.eval()
         i_time = time.time()
+        timing = {'forward': 0, 'rank': 0, 'wait': 0, 'queries': 0, 'batches': 0, 'backoffs': 0}
         with (torch.no_grad()):
             # - - - - - - val set - - - - - -
             if not eval_val:
                 v_mrr, v_h1, v_h3, v_h10, v_h50, v_map_1, v_map_3, v_map_10, v_map_50 = 0, 0, 0, 0, 0, 0, 0, 0, 0
             else:
-                iterator = tqdm(range(n_batch), position=0) if verbose else range(n_batch)
-                num=[]
-                for i in iterator:
-                    start = i*batch_size
-                    end = min(n_data, (i+1)*batch_size)
-                    batch_idx = np.arange(start, end)
-                    subs, rels, objs, nums = self.loader.get_batch(batch_idx, data='valid')
-                    num+=nums
-                    scores = self.model(subs, rels, mode='valid', inference_path=inference_path)
-                    scores = scores.data.cpu().numpy()
-
-                    filters = []
-
-                    for i in range(len(subs)):
-                        filt = self.loader.filters[(subs[i], rels[i])]
-                        filt_1hot = np.zeros((self.n_ent, ))
-                        filt_1hot[np.array(filt)] = 1
-                        filters.append(filt_1hot)
-
-                    # scores / objs / filters: [batch_size, n_ent]
-                    filters = np.array(filters)
-                    ranks = cal_ranks(scores, objs, filters)
-                    ranking += ranks
-
-                ranking = np.array(ranking)
-                v_mrr, v_h1, v_h3 ,v_h10,v_h50,v_map_1, v_map_3, v_map_10, v_map_50 = cal_performance(ranking,num)
+                ranking, num, split_timing = self.eval_split('valid', verbose)
+                v_mrr, v_h1, v_h3 ,v_h10,v_h50,v_map_1, v_map_3, v_map_10, v_map_50 = cal_performance(ranking, num)
+                timing = {k: timing[k] + split_timing[k] for k in timing}
 
             # - - - - - - test set - - - - - -
             if not eval_test:
-                t_mrr, t_h1, t_h10 = -1, -1, -1
+                t_mrr, t_h1, t_h3, t_h10, t_h50, t_map_1, t_map_3, t_map_10, t_map_50 = -1, -1, -1, -1, -1, -1, -1, -1, -1
             else:
-                n_data = self.n_test
-                n_batch = n_data // batch_size + (n_data % batch_size > 0)
-                ranking = []
-                self.model.eval()
-                iterator = tqdm(range(n_batch), position=0) if verbose else range(n_batch)
-                num=[]
-                for i in iterator:
-                    start = i*batch_size
-                    end = min(n_data, (i+1)*batch_size)
-                    batch_idx = np.arange(start, end)
-                    subs, rels, objs,nums = self.loader.get_batch(batch_idx, data='test')
-                    num += nums
-                    scores = self.model(subs, rels, mode='test', inference_path=inference_path)
-                    scores = scores.data.cpu().numpy()
-                    filters = []
-                    for i in range(len(subs)):
-                        filt = self.loader.filters[(subs[i], rels[i])]
-                        filt_1hot = np.zeros((self.n_ent, ))
-                        filt_1hot[np.array(filt)] = 1
-                        filters.append(filt_1hot)
-
-                    filters = np.array(filters)
-                    ranks = cal_ranks(scores, objs, filters)
-                    ranking += ranks
-
-                ranking = np.array(ranking)
-                t_mrr, t_h1, t_h3 ,t_h10,t_h50,t_map_1, t_map_3, t_map_10, t_map_50 = cal_performance(ranking,num)
+                ranking, num, split_timing = self.eval_split('test', verbose)
+                t_mrr, t_h1, t_h3 ,t_h10,t_h50,t_map_1, t_map_3, t_map_10, t_map_50 = cal_performance(ranking, num)
+                timing = {k: timing[k] + split_timing[k] for k in timing}
 
             i_time = time.time() - i_time
             out_str = (
                     '[VALID] MRR:%.4f H@1:%.4f H@3:%.4f H@10:%.4f\t H@50:%.4f MAP@1:%.4f MAP@3:%.4f MAP@10:%.4f MAP@50:%.4f\t'
                     '[TEST] MRR:%.4f H@1:%.4f H@3:%.4f H@10:%.4f\t H@50:%.4f MAP@1:%.4f MAP@3:%.4f MAP@10:%.4f MAP@50:%.4f\t'
-                    '[TIME] train:%.4f inference:%.4f\n'
+                    '[TIME] train:%.4f inference:%.4f forward:%.4f rank:%.4f wait:%.4f\t'
+                    '[EVAL] queries/s:%.1f batch:%.1f backoffs:%d\t'
+                    '[HEALTH] %s\n'
                     % (
                         v_mrr, v_h1, v_h3 , v_h10, v_h50, v_map_1, v_map_3, v_map_10, v_map_50,
                         t_mrr, t_h1, t_h3, t_h10, t_h50, t_map_1, t_map_3, t_map_10, t_map_50,
-                        self.t_time, i_time
+                        self.t_time, i_time, timing['forward'], timing['rank'], self.t_wait + timing['wait'],
+                        timing['queries'] / i_time, timing['queries'] / max(timing['batches'], 1), timing['backoffs'],
+                        self.health.summary()
                     )
             )
 
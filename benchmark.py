@@ -0,0 +1,309 @@
+# -*- coding:utf-8 -*-
+import argparse
+import multiprocessing
+import resource
+import time
+from functools import partial
+
+import numpy as np
+import torch
+from scipy.sparse import csr_matrix
+
+from load_data import DataLoader_DisGeNet, DataLoader_STITCH, DataLoader_UMLS
+from kg_index import gather_neighbors
+from utils import cal_ranks, count_ranks, init_distributed, setup_device
+
+
+''' micro benchmarks of BioGraphFusion '''
+parser = argparse.ArgumentParser(description="Benchmarks for BioGraphFusion")
+parser.add_argument('--data_path', type=str, default='data/Protein-Chemical/STITCH')
+parser.add_argument('--bench', type=str, default='neighbors')
+parser.add_argument('--seed', type=int, default=1234)
+parser.add_argument('--topk', type=int, default=300)
+parser.add_argument('--layers', type=int, default=6)
+parser.add_argument('--batchsize', type=int, default=10)
+parser.add_argument('--repeat', type=int, default=20)
+parser.add_argument('--fact_ratio', type=float, default=0.92)
+parser.add_argument('--max_BKG_triples', type=int, default=15000)
+parser.add_argument('--device', type=str, default=None)
+parser.add_argument('--threads', type=int, default=None)
+parser.add_argument('--hidden_dim', type=int, default=64)
+parser.add_argument('--nodes', type=int, default=5000, help='Frontier size of the synthetic layer benchmark')
+parser.add_argument('--degree', type=int, nargs='+', default=[4, 16, 64], help='Out-degrees of the synthetic frontiers')
+parser.add_argument('--n_ent', type=int, default=40000, help='Entities of the synthetic score matrices of the rank benchmark')
+parser.add_argument('--budgets', type=float, nargs='+', default=[256, 1024, 4096], help='Evaluation memory budgets (MB) of the eval batch benchmark')
+parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='World sizes of the data parallel benchmark')
+parser.add_argument('--dist_port', type=int, default=29500)
+
+
+def get_loader(args):
+    dataset = [p for p in args.data_path.split('/') if len(p) > 0][-1]
+    if dataset == 'DisGeNet_cv':
+        args.BKG_list = ['disease-drug.txt', 'chemical-gene.txt']
+        DataLoader = DataLoader_DisGeNet
+    elif dataset == 'STITCH':
+        args.BKG_list = ['disease-gene.txt', 'disease-drug.txt']
+        DataLoader = DataLoader_STITCH
+    else:
+        DataLoader = DataLoader_UMLS
+    return DataLoader(args)
+
+
+def timeit(fn, repeat):
+    fn()
+    t = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - t) / repeat
+
+
+def frontiers(loader, args):
+    # expand random queries layer by layer, keeping at most topk nodes per query
+    rng = np.random.RandomState(args.seed)
+    heads = rng.choice(np.unique(loader.train_data[:, 0]), args.batchsize, replace=False)
+    nodes = np.stack([np.arange(args.batchsize), heads], 1)
+    layers = []
+    for _ in range(args.layers):
+        layers.append(nodes)
+        edges = gather_neighbors(loader.KG, loader.KG_offsets, nodes)
+        nodes = np.unique(edges[:, [0, 3]], axis=0)
+        keep = np.concatenate([rng.permutation(np.nonzero(nodes[:, 0] == b)[0])[:args.topk]
+                               for b in range(args.batchsize)])
+        nodes = nodes[np.sort(keep)]
+    return layers
+
+
+def bench_neighbors(args):
+    loader = get_loader(args)
+    # reference: the one-hot sparse matmul used before the CSR index
+    KG, offsets = loader.KG, loader.KG_offsets
+    M_sub = csr_matrix((np.ones((loader.n_fact,)), (np.arange(loader.n_fact), KG[:, 0])),
+                       shape=(loader.n_fact, loader.n_ent))
+
+    def spmm(nodes):
+        node_1hot = csr_matrix((np.ones(len(nodes)), (nodes[:, 1], nodes[:, 0])),
+                               shape=(loader.n_ent, nodes.shape[0]))
+        edges = np.nonzero(M_sub.dot(node_1hot))
+        return np.concatenate([np.expand_dims(edges[1], 1), KG[edges[0]]], axis=1)
+
+    for i, nodes in enumerate(frontiers(loader, args)):
+        ref = spmm(nodes)
+        # equality with the reference is checked in tests/test_neighbors.py
+        out = gather_neighbors(KG, offsets, nodes)
+        t_ref = timeit(lambda: spmm(nodes), args.repeat)
+        t_out = timeit(lambda: gather_neighbors(KG, offsets, nodes), args.repeat)
+        print('layer %d nodes:%d edges:%d\t spmm:%.3fms csr:%.3fms speedup:%.1fx'
+              % (i, len(nodes), len(out), t_ref * 1000, t_out * 1000, t_ref / t_out))
+
+
+def model_opts(loader, args):
+    # the umls/STITCH settings of train.py, sized by --topk/--layers/--hidden_dim/--batchsize
+    args.n_ent, args.n_rel = loader.n_ent, loader.n_rel
+    args.lr, args.decay_rate, args.lamb = 0.0012, 0.998, 0.00014
+    args.attn_dim, args.dropout, args.act, args.tau = 5, 0.01, 'tanh', 1.0
+    args.n_layer, args.n_node_topk, args.n_edge_topk = args.layers, [args.topk] * args.layers, -1
+    args.n_batch = args.n_tbatch = args.batchsize
+    args.rdim, args.init, args.reg, args.lamda = 32, 1e-3, 0.1, 0.7
+    args.lossflag, args.Flag, args.gate = True, True, 'GRU'
+    args.optimizer, args.scheduler = 'Adam', 'exp'
+    return args
+
+
+def bench_train_eval(args):
+    # one training epoch and one validation pass of BaseModel on --device (cpu-only machines included)
+    from base_model import BaseModel
+    loader = get_loader(args)
+    model = BaseModel(model_opts(loader, args), loader)
+    print('device:%s threads:%d' % (model.device, torch.get_num_threads()))
+    n_train = loader.n_train
+    t = time.time()
+    model.train_batch()
+    t_train = time.time() - t
+    t = time.time()
+    _, out_str = model.evaluate(verbose=False)
+    t_eval = time.time() - t
+    print('train: %.2fs %.1f triples/s\t valid: %.2fs %.1f queries/s'
+          % (t_train, n_train / t_train, t_eval, loader.n_valid / t_eval))
+    print(out_str)
+
+
+def amp_epoch(args, amp, queue):
+    # one training epoch in fp32 or mixed precision; run in a fresh process so peak memory is its own
+    from base_model import BaseModel
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    setup_device(args)
+    loader = get_loader(args)
+    args.amp = amp
+    model = BaseModel(model_opts(loader, args), loader)
+    if model.device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(model.device)
+    t = time.time()
+    loss = model.train_batch()
+    t = time.time() - t
+    if model.device.type == 'cuda':
+        peak = torch.cuda.max_memory_allocated(model.device) / 2 ** 20
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10  # KB on linux
+    queue.put((str(model.amp_dtype) if amp else 'torch.float32', loader.n_train / t, peak, loss))
+
+
+def bench_amp(args):
+    # training throughput and peak memory (allocated on gpu, process RSS on cpu) of fp32 against --amp
+    ctx = multiprocessing.get_context('spawn')
+    for amp in (False, True):
+        queue = ctx.Queue()
+        p = ctx.Process(target=amp_epoch, args=(args, amp, queue))
+        p.start()
+        dtype, throughput, peak, loss = queue.get()
+        p.join()
+        print('%s\t %.1f triples/s peak memory:%.1fMB epoch loss:%.2f' % (dtype, throughput, peak, loss))
+
+
+def ddp_epoch(rank, args, queue):
+    # one rank of a data parallel training epoch; --threads are split over the ranks on cpu
+    import random
+    from base_model import BaseModel
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    init_distributed(rank, args)
+    loader = get_loader(args)
+    model = BaseModel(model_opts(loader, args), loader)
+    t = time.time()
+    loss = model.train_batch()
+    t = time.time() - t
+    if rank == 0:
+        queue.put((t, torch.get_num_threads(), loss))
+
+
+def bench_ddp(args):
+    # epoch time of data parallel training against the number of worker processes
+    ctx = multiprocessing.get_context('spawn')
+    threads = args.threads
+    base = None
+    for world_size in args.workers:
+        args.world_size, args.threads = world_size, threads
+        args.device = None if args.device.startswith('cuda') else args.device
+        queue = ctx.Queue()
+        procs = [ctx.Process(target=ddp_epoch, args=(rank, args, queue)) for rank in range(world_size)]
+        for p in procs:
+            p.start()
+        t, n_threads, loss = queue.get()
+        for p in procs:
+            p.join()
+        base = base or t
+        print('workers:%d threads/worker:%d	 epoch: %.2fs speedup:%.2fx epoch loss:%.2f'
+              % (world_size, n_threads, t, base / t, loss))
+
+
+def synthetic_layer(args, degree, n_rel=20, n_ent=50000):
+    # a GNNLayer over a random frontier of --nodes nodes in --batchsize queries, each node with `degree` edges
+    from models import GNNLayer
+    from relation_refinement import Refinement
+    device = torch.device(args.device)
+    emb = Refinement((n_ent, 2 * n_rel + 1), args.hidden_dim, 32, 'LSTMCell').to(device)
+    layer = GNNLayer(args.hidden_dim, args.hidden_dim, 5, n_rel, n_ent, act=torch.tanh, emb_model=emb).to(device)
+    node_batch = torch.sort(torch.randint(0, args.batchsize, (args.nodes,))).values
+    node_ent = torch.randint(0, n_ent, (args.nodes,))
+    sub = torch.arange(args.nodes).repeat_interleave(degree)
+    tail = torch.randint(0, args.nodes, (len(sub),))
+    # [N_edge, 6] with (batch_idx, head, rela, tail, head_idx, tail_idx)
+    # a node's edges share its entity as head and use few relations, as in the real graphs
+    rela = (torch.randint(0, 2 * n_rel + 1, (args.nodes,))[sub] + torch.randint(0, 3, (len(sub),))) % (2 * n_rel + 1)
+    edges = torch.stack([node_batch[sub], node_ent[sub], rela,
+                         node_ent[tail], sub, tail], 1).to(device)
+    q_sub = torch.randint(0, n_ent, (args.batchsize,), device=device)
+    q_rel = torch.randint(0, n_rel, (args.batchsize,), device=device)
+    hidden = torch.randn(args.nodes, args.hidden_dim, device=device, requires_grad=True)
+    return layer, q_sub, q_rel, hidden, edges
+
+
+def edge_level_attention(layer, q_sub, q_rel, hidden, edges):
+    # reference: gather onto the edges first, then project every edge
+    hs = hidden[edges[:, 4]]
+    hr = layer.rela_embed(edges[:, 1], edges[:, 2])
+    h_qr = layer.rela_embed(q_sub, q_rel)[edges[:, 0]]
+    return layer.Ws_attn(hs) + layer.Wr_attn(hr) + layer.Wqr_attn(h_qr), hs + hr
+
+
+def bench_layer(args):
+    # GNNLayer.edge_attention (node/pair/query-level projections) against the edge-level reference, forward + backward
+    for degree in args.degree:
+        layer, q_sub, q_rel, hidden, edges = synthetic_layer(args, degree)
+        layer.train()
+        reference = partial(edge_level_attention, layer)
+
+        def step(fn):
+            attn, message = fn(q_sub, q_rel, hidden, edges)
+            (attn.sum() + message.sum()).backward()
+            return attn, message
+
+        ref, out = step(reference), step(layer.edge_attention)
+        err = max((ref[0] - out[0]).abs().max().item(), (ref[1] - out[1]).abs().max().item())
+        t_ref = timeit(lambda: step(reference), args.repeat)
+        t_out = timeit(lambda: step(layer.edge_attention), args.repeat)
+        print('degree %d nodes:%d edges:%d\t edge-level:%.3fms node-level:%.3fms speedup:%.1fx max_err:%.2e'
+              % (degree, args.nodes, len(edges), t_ref * 1000, t_out * 1000, t_ref / t_out, err))
+
+
+def bench_eval_batch(args):
+    # validation throughput with n_tbatch = --batchsize queries per batch against batches sized to --budgets
+    from base_model import BaseModel
+    loader = get_loader(args)
+    model = BaseModel(model_opts(loader, args), loader)
+    model.model.eval()
+    for budget in [0] + args.budgets:
+        args.eval_budget = budget
+        if model.device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(model.device)
+        t = time.time()
+        with torch.no_grad():
+            _, _, timing = model.eval_split('valid', verbose=False)
+        t = time.time() - t
+        peak = torch.cuda.max_memory_allocated(model.device) / 2 ** 20 if model.device.type == 'cuda' else float('nan')
+        print('%s\t %.1f queries/s batch:%.1f backoffs:%d peak memory:%.1fMB'
+              % ('batchsize %d' % args.batchsize if budget == 0 else 'budget %.0fMB' % budget,
+                 timing['queries'] / t, timing['queries'] / timing['batches'], timing['backoffs'], peak))
+
+
+def bench_ranks(args):
+    # filtered ranks of --batchsize queries over --n_ent entities: rankdata on host against counting on --device
+    rng = np.random.RandomState(args.seed)
+    # coarse scores, so that ties occur
+    scores = np.round(rng.randn(args.batchsize, args.n_ent), 2).astype(np.float32)
+    filters = rng.rand(args.batchsize, args.n_ent) < 0.001
+    labels = np.zeros_like(filters)
+    labels[np.arange(args.batchsize), rng.randint(0, args.n_ent, args.batchsize)] = True
+    labels |= filters & (rng.rand(args.batchsize, args.n_ent) < 0.5)
+    filters |= labels
+    objs, filter_idx = np.nonzero(labels), np.nonzero(filters)
+    device_scores = torch.from_numpy(scores).to(args.device)
+    # equality with cal_ranks is checked in tests/test_ranks.py
+    ref = cal_ranks(scores, objs, filters)
+
+    def sync():
+        if device_scores.is_cuda:
+            torch.cuda.synchronize()
+
+    t_ref = timeit(lambda: cal_ranks(device_scores.cpu().numpy(), objs, filters), args.repeat)
+    t_host = timeit(lambda: count_ranks(device_scores.cpu().numpy(), objs, filter_idx), args.repeat)
+    t_device = timeit(lambda: (count_ranks(device_scores, objs, filter_idx), sync()), args.repeat)
+    print('queries:%d answers:%d n_ent:%d	 rankdata:%.3fms count(numpy):%.3fms count(%s):%.3fms'
+          % (args.batchsize, len(ref), args.n_ent, t_ref * 1000, t_host * 1000, args.device, t_device * 1000))
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    args.device = str(setup_device(args))
+    {
+        'neighbors': bench_neighbors,
+        'train_eval': bench_train_eval,
+        'layer': bench_layer,
+        'amp': bench_amp,
+        'ddp': bench_ddp,
+        'ranks': bench_ranks,
+        'eval_batch': bench_eval_batch,
+    }[args.bench](args)
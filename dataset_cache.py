@@ -0,0 +1,80 @@
+# -*- coding:utf-8 -*-
+import hashlib
+import os
+import zipfile
+
+import numpy as np
+
+from kg_index import FilterIndex, TripleStore
+
+# bump when the parsing of the raw files or the cache layout changes
+CACHE_VERSION = 1
+
+
+def cache_digest(loader, sources):
+    # content hash of the raw files a loader parses, together with the loader type
+    digest = hashlib.sha1(f'{CACHE_VERSION}-{type(loader).__name__}'.encode())
+    for source in sources:
+        digest.update(source.encode())
+        with open(os.path.join(loader.task_dir, source), 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_path(loader):
+    return os.path.join(loader.task_dir, 'cache', f'{type(loader).__name__}.npz')
+
+
+def load_cache(loader, sources):
+    # restore the vocabularies and the filters of a loader from its binary cache
+    # return: {source: TripleStore}, or None when the cache is missing, stale or unreadable
+    if getattr(loader.args, 'no_cache', False) or not os.path.exists(cache_path(loader)):
+        return None
+    try:
+        with np.load(cache_path(loader), allow_pickle=False) as f:
+            if int(f['version']) != CACHE_VERSION or str(f['digest']) != cache_digest(loader, sources):
+                return None
+            arrays = {name: f[name] for name in f.files}
+        entities, relations = arrays['entities'].tolist(), arrays['relations'].tolist()
+        filters = FilterIndex(arrays['filter_keys'], arrays['filter_offsets'], arrays['filter_answers'],
+                              int(arrays['filter_n_rela']))
+        triples = {source: TripleStore.from_array(arrays[f'triples_{i}'])
+                   for i, source in enumerate(sources) if f'triples_{i}' in arrays}
+    except (OSError, EOFError, ValueError, KeyError, zipfile.BadZipFile) as e:
+        # truncated or corrupt, e.g. a partial copy: parsed again and rewritten
+        print('==> ignoring unreadable dataset cache %s: %r' % (cache_path(loader), e))
+        return None
+
+    loader.entity2id = dict(zip(entities, range(len(entities))))
+    loader.relation2id = dict(zip(relations, range(len(relations))))
+    loader.n_ent = len(entities)
+    loader.n_rel = len(relations)
+    loader.filters = filters
+    return triples
+
+
+def save_cache(loader, sources, triples):
+    # triples: {source: TripleStore} parsed from each raw file
+    if getattr(loader.args, 'no_cache', False):
+        return
+    arrays = {
+        'version': np.array(CACHE_VERSION),
+        'digest': np.array(cache_digest(loader, sources)),
+        'entities': np.array(sorted(loader.entity2id, key=loader.entity2id.get)),
+        'relations': np.array(sorted(loader.relation2id, key=loader.relation2id.get)),
+        'filter_keys': loader.filters.keys,
+        'filter_offsets': loader.filters.offsets,
+        'filter_answers': loader.filters.answers,
+        'filter_n_rela': np.array(loader.filters.n_rela),
+    }
+    for i, source in enumerate(sources):
+        if source in triples:
+            arrays[f'triples_{i}'] = triples[source].to_array(np.int32)
+
+    path = cache_path(loader)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # write to a temporary file first so that an interrupted run never leaves a broken cache
+    with open(path + '.tmp', 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(path + '.tmp', path)
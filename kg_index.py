@@ -0,0 +1,313 @@
+# -*- coding:utf-8 -*-
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+def build_head_index(KG, n_ent):
+    # sort the facts by head entity and build CSR offsets over them
+    # KG: [N_fact, 3] with (head, rela, tail)
+    # offsets: [N_ent + 1], facts of entity e are KG[offsets[e]:offsets[e+1]]
+    order = np.argsort(KG[:, 0], kind='stable')
+    KG = KG[order]
+    offsets = np.zeros(n_ent + 1, dtype=np.int64)
+    np.cumsum(np.bincount(KG[:, 0], minlength=n_ent), out=offsets[1:])
+    return KG, offsets
+
+
+def csr_positions(starts, counts):
+    # positions of the values of several CSR rows, concatenated row after row
+    # starts: [N_row], first position of every row; counts: [N_row], length of every row
+    out_starts = np.cumsum(counts) - counts
+    return np.arange(counts.sum()) + np.repeat(starts - out_starts, counts)
+
+
+def gather_neighbors(KG, offsets, nodes):
+    # nodes: [N_ent_of_all_batch_last, 2] with (batch_idx, node_idx)
+    # return: [N_edge_of_all_batch, 4] with (batch_idx, head, rela, tail)
+    starts = offsets[nodes[:, 1]]
+    counts = offsets[nodes[:, 1] + 1] - starts
+    fact_idx = csr_positions(starts, counts)
+    return np.concatenate([np.repeat(nodes[:, :1], counts, axis=0), np.take(KG, fact_idx, axis=0)], axis=1)
+
+
+def frontier_cost(KG, offsets, heads, n_node_topk):
+    # estimated number of edges a query starting at each of `heads` expands over all layers,
+    # from the degrees of the fact graph KG (sorted by head, see build_head_index)
+    # n_node_topk: per layer, nodes sampled into the next frontier (<= 0 keeps them all)
+    deg = np.diff(offsets).astype(np.float64)
+    # edges of the 2-hop expansion of every entity, and the mean degree of its neighbors
+    deg2 = np.bincount(KG[:, 0], weights=deg[KG[:, 2]], minlength=len(deg))
+    edges = deg[heads]
+    mean_deg = deg2[heads] / np.maximum(edges, 1)
+    cost = edges.copy()
+    nodes = np.ones(len(heads))
+    for topk in n_node_topk[:-1]:
+        # previous nodes are kept (self-loops), at most topk new ones are added
+        nodes = edges if topk <= 0 else np.minimum(edges, nodes + topk)
+        edges = nodes * mean_deg
+        cost += edges
+    return cost
+
+
+def reindex_edges(sampled_edges, n_rel):
+    # sampled_edges: [N_edge_of_all_batch, 4] tensor with (batch_idx, head, rela, tail)
+
+    # indexing nodes | within/out of a batch | relative index
+    # note that node_idx is the absolute nodes idx in original KG
+    # head_nodes: [N_ent_of_all_batch_last, 2] with (batch_idx, node_idx)
+    # tail_nodes: [N_ent_of_all_batch_this, 2] with (batch_idx, node_idx)
+    # head_index: [N_edge_of_all_batch] with relative node idx
+    # tail_index: [N_edge_of_all_batch] with relative node idx
+    head_nodes, head_index = torch.unique(sampled_edges[:, [0, 1]], dim=0, sorted=True, return_inverse=True)
+    tail_nodes, tail_index = torch.unique(sampled_edges[:, [0, 3]], dim=0, sorted=True, return_inverse=True)
+
+    # [N_edge_of_all_batch, 4] -> [N_edge_of_all_batch, 6] with (batch_idx, head, rela, tail, head_index, tail_index)
+    # node that the head_index and tail_index are of this layer
+    sampled_edges = torch.cat([sampled_edges, head_index.unsqueeze(1), tail_index.unsqueeze(1)], 1)
+
+    # get new index for nodes in last layer
+    mask = sampled_edges[:, 2] == (n_rel*2)
+    # old_nodes_new_idx: [N_ent_of_all_batch_last]
+    old_nodes_new_idx = tail_index[mask].sort()[0]
+
+    return tail_nodes, sampled_edges, old_nodes_new_idx
+
+
+class DeviceNeighbors(object):
+    # neighbor expansion with tensor ops on the device of the frontier, same contract as
+    # DataLoader.get_neighbors. The head-sorted train/test KG of the loader are mirrored as
+    # tensors and uploaded again only when the loader swaps its train KG (shuffle_train).
+    def __init__(self, loader):
+        self.loader = loader
+        self.graphs = {}
+
+    def graph(self, mode, device):
+        if mode == 'train':
+            KG, offsets = self.loader.KG, self.loader.KG_offsets
+        else:
+            KG, offsets = self.loader.tKG, self.loader.tKG_offsets
+        cached = self.graphs.get(mode)
+        if cached is None or cached[0] is not KG or cached[1].device != device:
+            cached = (KG, torch.as_tensor(KG, dtype=torch.long).to(device),
+                      torch.as_tensor(offsets, dtype=torch.long).to(device))
+            self.graphs[mode] = cached
+        return cached[1], cached[2]
+
+    def get_neighbors(self, nodes, batchsize, mode='train'):
+        # nodes: [N_ent_of_all_batch_last, 2] tensor with (batch_idx, node_idx)
+        KG, offsets = self.graph(mode, nodes.device)
+        starts = offsets[nodes[:, 1]]
+        counts = offsets[nodes[:, 1] + 1] - starts
+        row = torch.repeat_interleave(torch.arange(len(nodes), device=nodes.device), counts)
+        out_starts = torch.cumsum(counts, 0) - counts
+        fact_idx = torch.arange(len(row), device=nodes.device) + (starts - out_starts)[row]
+        # [N_edge_of_all_batch, 4] with (batch_idx, head, rela, tail)
+        sampled_edges = torch.cat([nodes[row, :1], KG[fact_idx]], 1)
+        return reindex_edges(sampled_edges, self.loader.n_rel)
+
+
+class QueryCSR(object):
+    # CSR of entity lists keyed by query id, e.g. the answers or the known answers of the valid queries
+    # offsets: [N_query + 1], entities of the i-th query are values[offsets[i]:offsets[i+1]]
+    def __init__(self, offsets, values):
+        self.offsets = offsets
+        self.values = values
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, idx):
+        return self.values[self.offsets[idx]:self.offsets[idx + 1]]
+
+    def counts(self, batch_idx):
+        return self.offsets[batch_idx + 1] - self.offsets[batch_idx]
+
+    def gather(self, batch_idx):
+        # return: (rows, values) of every entity of the batch, rows index into batch_idx
+        counts = self.counts(batch_idx)
+        if len(batch_idx) > 0 and np.all(np.diff(batch_idx) == 1):
+            # consecutive queries, their values are a single slice
+            values = self.values[self.offsets[batch_idx[0]]:self.offsets[batch_idx[-1] + 1]]
+        else:
+            values = self.values[csr_positions(self.offsets[batch_idx], counts)]
+        return np.repeat(np.arange(len(batch_idx)), counts), values
+
+
+class FilterIndex(object):
+    # CSR index of the known answers of every (head, rela) query
+    # keys: [N_query], sorted head * n_rela + rela
+    # offsets: [N_query + 1], answers of the i-th query are answers[offsets[i]:offsets[i+1]]
+    def __init__(self, keys, offsets, answers, n_rela):
+        self.keys = keys
+        self.offsets = offsets
+        self.answers = answers
+        self.n_rela = n_rela
+
+    @classmethod
+    def from_triples(cls, triples, n_rela):
+        # triples: TripleStore, the answers of query (head, rela) are the distinct tails
+        keys = triples.head.astype(np.int64) * n_rela + triples.rela
+        order = np.lexsort((triples.tail, keys))
+        keys, answers = keys[order], triples.tail[order]
+        # drop repeated (head, rela, tail)
+        keep = np.ones(len(keys), dtype=bool)
+        keep[1:] = (keys[1:] != keys[:-1]) | (answers[1:] != answers[:-1])
+        keys, answers = keys[keep], answers[keep]
+        keys, counts = np.unique(keys, return_counts=True)
+        offsets = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return cls(keys, offsets, answers, n_rela)
+
+    def find(self, heads, relas):
+        # row of each (head, rela) query in the index, -1 if it has no known answer
+        keys = np.asarray(heads, dtype=np.int64) * self.n_rela + np.asarray(relas, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[rows] == keys, rows, -1) if len(self.keys) else np.full(keys.shape, -1)
+
+    def query_filters(self, queries):
+        # known answers keyed by query id
+        # queries: [N_query, 2] with (head, rela)
+        rows = self.find(queries[:, 0], queries[:, 1])
+        starts = self.offsets[np.maximum(rows, 0)]
+        counts = np.where(rows >= 0, self.offsets[np.maximum(rows, 0) + 1] - starts, 0)
+        offsets = np.zeros(len(rows) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return QueryCSR(offsets, self.answers[csr_positions(starts, counts)])
+
+    def __getitem__(self, query):
+        row = self.find(query[0], query[1])
+        if row < 0:
+            return self.answers[:0]
+        return self.answers[self.offsets[row]:self.offsets[row + 1]]
+
+    def __contains__(self, query):
+        return self.find(query[0], query[1]) >= 0
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class TripleStore(object):
+    # columnar store of (head, rela, tail) triples in contiguous int32 arrays
+    def __init__(self, head, rela, tail):
+        self.head = np.ascontiguousarray(head, dtype=np.int32)
+        self.rela = np.ascontiguousarray(rela, dtype=np.int32)
+        self.tail = np.ascontiguousarray(tail, dtype=np.int32)
+
+    @classmethod
+    def from_array(cls, triples):
+        # triples: [N_triple, 3] with (head, rela, tail)
+        triples = np.asarray(triples).reshape(-1, 3)
+        return cls(triples[:, 0], triples[:, 1], triples[:, 2])
+
+    @classmethod
+    def concat(cls, stores):
+        stores = list(stores)
+        if not stores:
+            return cls(np.zeros(0), np.zeros(0), np.zeros(0))
+        return cls(np.concatenate([s.head for s in stores]), np.concatenate([s.rela for s in stores]),
+                   np.concatenate([s.tail for s in stores]))
+
+    def __len__(self):
+        return len(self.head)
+
+    def __getitem__(self, idx):
+        return TripleStore(self.head[idx], self.rela[idx], self.tail[idx])
+
+    def to_array(self, dtype=np.int64):
+        # [N_triple, 3] with (head, rela, tail)
+        triples = np.empty((len(self), 3), dtype=dtype)
+        triples[:, 0], triples[:, 1], triples[:, 2] = self.head, self.rela, self.tail
+        return triples
+
+    def doubled(self, n_rel):
+        # append the inverse triple (tail, rela + n_rel, head) of every triple
+        return TripleStore(np.concatenate([self.head, self.tail]), np.concatenate([self.rela, self.rela + n_rel]),
+                           np.concatenate([self.tail, self.head]))
+
+    def group_queries(self):
+        # group the distinct tails by (head, rela) query, queries are numbered by first appearance
+        # queries: [N_query, 2] with (head, rela)
+        # offsets: [N_query + 1], sorted tails of the i-th query are answers[offsets[i]:offsets[i+1]]
+        n_rela = int(self.rela.max()) + 1 if len(self) else 1
+        keys = self.head.astype(np.int64) * n_rela + self.rela
+        _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+        rank = np.empty(len(first), dtype=np.int64)
+        rank[np.argsort(first)] = np.arange(len(first))
+        query_idx = rank[inverse.reshape(-1)]
+
+        first = np.sort(first)
+        queries = np.stack([self.head[first], self.rela[first]], 1).astype(np.int64)
+        order = np.lexsort((self.tail, query_idx))
+        query_idx, answers = query_idx[order], self.tail[order]
+        # drop repeated answers of a query
+        keep = np.ones(len(answers), dtype=bool)
+        keep[1:] = (query_idx[1:] != query_idx[:-1]) | (answers[1:] != answers[:-1])
+        offsets = np.zeros(len(first) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(query_idx[keep], minlength=len(first)), out=offsets[1:])
+        return queries, offsets, answers[keep]
+
+
+class TrainSplitter(object):
+    # re-splits the fact + train triples into the fact graph and the training queries of an epoch
+    # the doubled triples and the identity triples are sorted by head once, every split then
+    # compacts them with a boolean mask and recounts the head offsets, without sorting again
+    def __init__(self, all_triple, n_rel, n_ent, fact_ratio, remove_1hop_edges=False, background=False):
+        self.n_rel = n_rel
+        self.n_ent = n_ent
+        self.n_all = len(all_triple)
+        self.fact_ratio = fact_ratio
+        self.remove_1hop_edges = remove_1hop_edges
+        self.triples = TripleStore.from_array(all_triple)
+
+        idd = TripleStore(np.arange(n_ent), np.full(n_ent, 2*n_rel), np.arange(n_ent))
+        # int32 like the TripleStore; gather_neighbors and DeviceNeighbors widen the edges they hand to torch
+        KG = TripleStore.concat([self.triples.doubled(n_rel), idd]).to_array(np.int32)
+        # source[i]: index of the i-th sorted fact in the doubled triples, >= 2*n_all for identity triples
+        self.source = np.argsort(KG[:, 0], kind='stable').astype(np.int32)
+        self.KG = KG[self.source]
+        if remove_1hop_edges:
+            # 64-bit (head, tail) key of every sorted fact
+            self.KG_keys = self.KG[:, 0].astype(np.int64) * n_ent + self.KG[:, 2]
+
+        # the next split is prepared in a background thread while the current epoch trains,
+        # it draws from its own random state seeded from the global one
+        self.executor = None
+        if background:
+            self.rng = np.random.RandomState(np.random.randint(1 << 31))
+            self.executor = ThreadPoolExecutor(max_workers=1)
+            self.pending = self.executor.submit(self.split, self.rng)
+
+    def split(self, rng):
+        # return: KG [N_fact, 3] sorted by head, offsets [N_ent + 1], train_data [N_train, 3]
+        perm = rng.permutation(self.n_all)
+        bar = int(self.n_all * self.fact_ratio)
+        is_fact = np.zeros(self.n_all, dtype=bool)
+        is_fact[perm[:bar]] = True
+        keep = np.concatenate([is_fact, is_fact, np.ones(self.n_ent, dtype=bool)])[self.source]
+
+        train = self.triples[perm[bar:]].doubled(self.n_rel).to_array(np.int32)
+
+        if self.remove_1hop_edges:
+            print('==> removing 1-hop links...')
+            # drop the facts whose (head, tail) is a training pair, found by binary search
+            # in the sorted training keys so that memory scales with the number of edges
+            train_keys = np.unique(train[:, 0].astype(np.int64) * self.n_ent + train[:, 2])
+            pos = np.minimum(np.searchsorted(train_keys, self.KG_keys), len(train_keys) - 1)
+            is_train_pair = train_keys[pos] == self.KG_keys if len(train_keys) else np.zeros(len(keep), dtype=bool)
+            keep &= ~is_train_pair | (self.source >= 2 * self.n_all)
+            print('==> done')
+
+        KG = self.KG[keep]
+        offsets = np.zeros(self.n_ent + 1, dtype=np.int64)
+        np.cumsum(np.bincount(KG[:, 0], minlength=self.n_ent), out=offsets[1:])
+        return KG, offsets, train
+
+    def next_split(self):
+        if self.executor is None:
+            return self.split(np.random)
+        split = self.pending.result()
+        self.pending = self.executor.submit(self.split, self.rng)
+        return split
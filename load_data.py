@@ -1,13 +1,16 @@
 import os
 import torch
-from scipy.sparse import csr_matrix
 import numpy as np
-from collections import defaultdict
 import random
+from array import array
+from kg_index import build_head_index, gather_neighbors, reindex_edges, FilterIndex, QueryCSR, TripleStore, TrainSplitter
+from dataset_cache import load_cache, save_cache
+from utils import get_device
 class DataLoader_DisGeNet:
     def __init__(self, args):
         self.args = args
         self.task_dir = task_dir = args.data_path
+        self.device = get_device(args)
 
         with open(os.path.join(task_dir, 'relations.txt')) as f:
             self.relation2id = dict()
@@ -23,43 +26,53 @@ class DataLoader_DisGeNet:
         self.entity2id = dict()
 
         # prepare triples
-        self.filters = defaultdict(lambda:set())
-
         self.BKG_list=BKG_list= args.BKG_list
-        self.fact_triple = self.read_BKG_triples(BKG_list,max_triples=args.max_BKG_triples)
-        self.train_triple = self.read_triples(f'train.txt')
-        self.valid_triple = self.read_triples(f'valid.txt')
-        self.test_triple  = self.read_triples(f'test.txt')
+        # the raw files are parsed once, later runs restore them from the binary cache in task_dir
+        BKG_sources = [os.path.join('../facts', filename) for filename in BKG_list]
+        sources = ['relations.txt'] + BKG_sources + ['train.txt', 'valid.txt', 'test.txt']
+        triples = load_cache(self, sources)
+        if triples is None:
+            triples = {source: self.read_BKG_file(filename) for source, filename in zip(BKG_sources, BKG_list)}
+            for filename in ['train.txt', 'valid.txt', 'test.txt']:
+                triples[filename] = self.read_triples(filename)
+            # known answers of the (head, rela) and the inverse (tail, rela + n_rel) queries
+            self.filters = FilterIndex.from_triples(TripleStore.concat(triples.values()).doubled(self.n_rel), 2*self.n_rel+1)
+            save_cache(self, sources, triples)
+
+        self.fact_triple = self.sample_BKG_triples([triples[source] for source in BKG_sources],max_triples=args.max_BKG_triples)
+        self.train_triple = triples['train.txt']
+        self.valid_triple = triples['valid.txt']
+        self.test_triple  = triples['test.txt']
 
         self.id2entity = {v: k for k, v in self.entity2id.items()}
         self.id2relation = {v: k for k, v in self.relation2id.items()}
 
-        self.all_triple = np.concatenate([np.array(self.fact_triple), np.array(self.train_triple)], axis=0)
-        self.tmp_all_triple = np.concatenate([np.array(self.fact_triple), np.array(self.train_triple), np.array(self.valid_triple), np.array(self.test_triple)], axis=0)
+        self.all_triple = TripleStore.concat([self.fact_triple, self.train_triple]).to_array(np.int32)
+        self.tmp_all_triple = TripleStore.concat([self.fact_triple, self.train_triple, self.valid_triple, self.test_triple]).to_array(np.int32)
         
         # add inverse
-        self.fact_data  = self.double_triple(self.fact_triple)
-        self.train_data = np.array(self.double_triple(self.train_triple))
-        self.valid_data = self.double_triple(self.valid_triple)
-        self.test_data  = self.double_triple(self.test_triple)
+        self.valid_data = self.valid_triple.doubled(self.n_rel)
+        self.test_data  = self.test_triple.doubled(self.n_rel)
 
+        self.splitter = TrainSplitter(self.all_triple, self.n_rel, self.n_ent, args.fact_ratio,
+                                      remove_1hop_edges=getattr(args, 'remove_1hop_edges', False),
+                                      background=getattr(args, 'async_shuffle', False))
         self.shuffle_train()
-        self.load_graph(self.fact_data)
-        self.load_test_graph(self.double_triple(self.fact_triple)+self.double_triple(self.train_triple))
+        self.load_test_graph(TripleStore.concat([self.fact_triple.doubled(self.n_rel), self.train_triple.doubled(self.n_rel)]).to_array(np.int32))
         self.valid_q, self.valid_a = self.load_query(self.valid_data)
         self.test_q,  self.test_a  = self.load_query(self.test_data)
+        # known answers of every valid/test query, for the filtered ranking
+        self.valid_filters = self.filters.query_filters(self.valid_q)
+        self.test_filters  = self.filters.query_filters(self.test_q)
 
         self.n_train = len(self.train_data)
         self.n_valid = len(self.valid_q)
         self.n_test  = len(self.test_q)
 
-        for filt in self.filters:
-            self.filters[filt] = list(self.filters[filt])
-
         print('n_train:', self.n_train, 'n_valid:', self.n_valid, 'n_test:', self.n_test, 'n_ent:', self.n_ent, 'n_rel:', self.n_rel)
 
     def read_triples(self, filename):
-        triples = []
+        triples = array('i')
         with open(os.path.join(self.task_dir, filename)) as f:
             for line in f:
                 h, r, t = line.strip().split()
@@ -77,172 +90,106 @@ class DataLoader_DisGeNet:
                 r_id = self.relation2id[r]
                 t_id = self.entity2id[t]
 
-                triples.append([h_id, r_id, t_id])
-                self.filters[(h_id, r_id)].add(t_id)
-                self.filters[(t_id, r_id + self.n_rel)].add(h_id)
+                triples.extend((h_id, r_id, t_id))
 
-        return triples
+        return TripleStore.from_array(np.frombuffer(triples, dtype=np.intc))
 
 
-    def read_BKG_triples(self, filenames,max_triples=10000):
-        triples = []
-        for filename in filenames:
-            file_triples = []
-            with open(os.path.join(self.task_dir, '../facts', filename)) as f:
-                for line in f:
-                    h, r, t = line.strip().split('\t')
-                    if h not in self.entity2id:
-                        self.entity2id[h] = self.n_ent
-                        self.n_ent += 1
+    def read_BKG_file(self, filename):
+        file_triples = array('i')
+        with open(os.path.join(self.task_dir, '../facts', filename)) as f:
+            for line in f:
+                h, r, t = line.strip().split('\t')
+                if h not in self.entity2id:
+                    self.entity2id[h] = self.n_ent
+                    self.n_ent += 1
 
-                    if t not in self.entity2id:
-                        self.entity2id[t] = self.n_ent
-                        self.n_ent += 1
+                if t not in self.entity2id:
+                    self.entity2id[t] = self.n_ent
+                    self.n_ent += 1
 
 
-                        # ȡӦ ID
-                        h_id = self.entity2id[h]
-                        r_id = self.relation2id[r]
-                        t_id = self.entity2id[t]
+                    # ȡӦ ID
+                    h_id = self.entity2id[h]
+                    r_id = self.relation2id[r]
+                    t_id = self.entity2id[t]
 
-                        file_triples.append([h_id, r_id, t_id])
-                        self.filters[(h_id, r_id)].add(t_id)
-                        self.filters[(t_id, r_id + self.n_rel)].add(h_id)
+                    file_triples.extend((h_id, r_id, t_id))
+        return TripleStore.from_array(np.frombuffer(file_triples, dtype=np.intc))
 
+    def sample_BKG_triples(self, BKG_triples,max_triples=10000):
+        triples = []
+        for file_triples in BKG_triples:
             # If the number of triples exceeds the maximum limit, randomly sample the maximum number of triples
             if max_triples!=-1 and len(file_triples) > max_triples:
-                file_triples = random.sample(file_triples, max_triples)
-
-            triples.extend(file_triples)
-        return triples
-
-    def double_triple(self, triples):
-        new_triples = []
-        for triple in triples:
-            h, r, t = triple
-            new_triples.append([t, r+self.n_rel, h]) 
-        return triples + new_triples
-
-    def load_graph(self, triples):
-        # (e, r', e)
-        # r' = 2 * n_rel, r' is manual generated and not exist in the original KG
-        # self.KG: shape=(self.n_fact, 3)
-        # M_sub shape=(self.n_fact, self.n_ent), store projection from head entity to triples
-        idd = np.concatenate([np.expand_dims(np.arange(self.n_ent),1), 2*self.n_rel*np.ones((self.n_ent, 1)), np.expand_dims(np.arange(self.n_ent),1)], 1)
-
-        self.KG = np.concatenate([np.array(triples), idd], 0)
-        self.n_fact = len(self.KG)
-        self.M_sub = csr_matrix((np.ones((self.n_fact,)), (np.arange(self.n_fact), self.KG[:,0])), shape=(self.n_fact, self.n_ent))
+                file_triples = file_triples[random.sample(range(len(file_triples)), max_triples)]
+
+            triples.append(file_triples)
+        return TripleStore.concat(triples)
 
     def load_test_graph(self, triples):
-        idd = np.concatenate([np.expand_dims(np.arange(self.n_ent),1), 2*self.n_rel*np.ones((self.n_ent, 1)), np.expand_dims(np.arange(self.n_ent),1)], 1)
+        idd = np.concatenate([np.expand_dims(np.arange(self.n_ent), 1), 2*self.n_rel*np.ones(
+            (self.n_ent, 1), dtype=np.int32), np.expand_dims(np.arange(self.n_ent), 1)], 1).astype(np.int32)
 
-        self.tKG = np.concatenate([np.array(triples), idd], 0)
-        self.tn_fact = len(self.tKG)
-        self.tM_sub = csr_matrix((np.ones((self.tn_fact,)), (np.arange(self.tn_fact), self.tKG[:,0])), shape=(self.tn_fact, self.n_ent))
+        # int32 as the train KG, widened only for the edges handed to torch
+        tKG = np.concatenate([np.array(triples, dtype=np.int32).reshape(-1, 3), idd], 0)
+        self.tn_fact = len(tKG)
+        self.tKG, self.tKG_offsets = build_head_index(tKG, self.n_ent)
 
     def load_query(self, triples):
-        trip_hr = defaultdict(lambda:list())
-
-        for trip in triples:
-            h, r, t = trip
-            trip_hr[(h,r)].append(t)
-        
-        queries = []
-        answers = []
-        for key in trip_hr:
-            queries.append(key)
-            answers.append(np.array(trip_hr[key]))
-        return queries, answers
+        # group the answers of every (head, rela) query, in order of first appearance
+        # answers: QueryCSR of the sorted, distinct answers keyed by query id
+        queries, offsets, answers = triples.group_queries()
+        return queries, QueryCSR(offsets, answers.astype(np.int64))
 
     def get_neighbors(self, nodes, batchsize, mode='train'):
         if mode == 'train':
-            KG    = self.KG #  [N_fact, 3] with (head, rela, tail)
-            M_sub = self.M_sub # [N_fact, N_ent]
+            KG = self.KG  # [N_fact, 3] with (head, rela, tail), sorted by head
+            offsets = self.KG_offsets  # [N_ent+1]
         else:
-            KG    = self.tKG
-            M_sub = self.tM_sub
+            KG = self.tKG
+            offsets = self.tKG_offsets
 
         # nodes: [N_ent_of_all_batch_last, 2] with (batch_idx, node_idx)
-        # [N_ent, N_ent_of_all_batch_last]
-        node_1hot     = csr_matrix((np.ones(len(nodes)), (nodes[:,1], nodes[:,0])), shape=(self.n_ent, nodes.shape[0]))
-        # [N_fact, N_ent] * [N_ent, N_ent_of_all_batch_last] -> [N_fact, N_ent_of_all_batch_last]
-        edge_1hot     = M_sub.dot(node_1hot)
-        # [2, N_edge_of_all_batch] with (fact_idx, batch_idx)
-        edges         = np.nonzero(edge_1hot)
-        # {batch_idx} + {head, rela, tail} -> concat -> [N_edge_of_all_batch, 4] with (batch_idx, head, rela, tail)
-        sampled_edges = np.concatenate([np.expand_dims(edges[1],1), KG[edges[0]]], axis=1)
-        sampled_edges = torch.LongTensor(sampled_edges).cuda()
-
-        # indexing nodes | within/out of a batch | relative index
-        # note that node_idx is the absolute nodes idx in original KG
-        # head_nodes: [N_ent_of_all_batch_last, 2] with (batch_idx, node_idx)
-        # tail_nodes: [N_ent_of_all_batch_this, 2] with (batch_idx, node_idx)
-        # head_index: [N_edge_of_all_batch] with relative node idx
-        # tail_index: [N_edge_of_all_batch] with relative node idx
-        head_nodes, head_index = torch.unique(sampled_edges[:,[0,1]], dim=0, sorted=True, return_inverse=True) # head_nodes.shape: torch.Size([20, 2]) with (batch_idx, node_idx)
-        tail_nodes, tail_index = torch.unique(sampled_edges[:,[0,3]], dim=0, sorted=True, return_inverse=True) # tail_nodes.shape: torch.Size([N_ent_of_all_batch_this, 2]) with (batch_idx, node_idx)
-
-        # [N_edge_of_all_batch, 4] -> [N_edge_of_all_batch, 6] with (batch_idx, head, rela, tail, head_index, tail_index)
-        # node that the head_index and tail_index are of this layer
-        sampled_edges = torch.cat([sampled_edges, head_index.unsqueeze(1), tail_index.unsqueeze(1)], 1)
-
-        # get new index for nodes in last layer
-        mask = sampled_edges[:,2] == (self.n_rel*2)
-        # old_nodes_new_idx: [N_ent_of_all_batch_last]
-        old_nodes_new_idx = tail_index[mask].sort()[0]
-
-        return tail_nodes, sampled_edges, old_nodes_new_idx
-
-    def get_batch(self, batch_idx, steps=2, data='train'):
-        if data=='train':
-            return np.array(self.train_data)[batch_idx]
-        if data=='valid':
-            query, answer = np.array(self.valid_q), np.array(self.valid_a, dtype=object)
-        if data=='test':
-            query, answer = np.array(self.test_q), np.array(self.test_a, dtype=object)
+        # gather the facts of each node through the head offsets
+        # -> [N_edge_of_all_batch, 4] with (batch_idx, head, rela, tail)
+        sampled_edges = gather_neighbors(KG, offsets, nodes)
+        sampled_edges = torch.LongTensor(sampled_edges).to(self.device)
+
+        return reindex_edges(sampled_edges, self.n_rel)
+
+    def get_batch(self, batch_idx, steps=2, data='train', dense=False):
+        if data == 'train':
+            return self.train_data[batch_idx]
+        if data == 'valid':
+            query, answer = self.valid_q, self.valid_a
+        if data == 'test':
+            query, answer = self.test_q, self.test_a
         subs = query[batch_idx, 0]
         rels = query[batch_idx, 1]
-        objs = np.zeros((len(batch_idx), self.n_ent))
-        for i in range(len(batch_idx)):
-            objs[i][answer[batch_idx[i]]] = 1
+        # objs: (rows, answers) of the batch, rows index into batch_idx
+        objs = answer.gather(batch_idx)
+        num = list(answer.counts(batch_idx))
 
-        if data!='train':
-            nonzero_indices=np.nonzero(objs)
-            rows = nonzero_indices[0]
-            num = []
-            unique_rows, counts = np.unique(rows, return_counts=True)
-            num = list(counts)
-            return subs, rels, objs, num
-
-        return subs, rels, objs
+        # dense [batch_size, n_ent] label matrix, only built on request
+        if dense:
+            labels = np.zeros((len(batch_idx), self.n_ent))
+            labels[objs] = 1
+            objs = labels
+        return subs, rels, objs, num
 
     def shuffle_train(self):
-        all_triple = self.all_triple
-        n_all = len(all_triple)
-        rand_idx = np.random.permutation(n_all)
-        all_triple = all_triple[rand_idx]
-
-        bar = int(n_all * self.args.fact_ratio)
-        self.fact_data = np.array(self.double_triple(all_triple[:bar].tolist()))
-        self.train_data = np.array(self.double_triple(all_triple[bar:].tolist()))
-
-        if hasattr(self.args, 'remove_1hop_edges') and self.args.remove_1hop_edges:
-            print('==> removing 1-hop links...')
-            tmp_index = np.ones((self.n_ent, self.n_ent))
-            tmp_index[self.train_data[:, 0], self.train_data[:, 2]] = 0
-            save_facts = tmp_index[self.fact_data[:, 0], self.fact_data[:, 2]].astype(bool)
-            self.fact_data = self.fact_data[save_facts]
-            print('==> done')
-
+        # re-split fact/train triples, the fact graph is compacted from the head-sorted index
+        self.KG, self.KG_offsets, self.train_data = self.splitter.next_split()
+        self.n_fact = len(self.KG)
         self.n_train = len(self.train_data)
-        self.load_graph(self.fact_data)
 
 
 class DataLoader_STITCH:
     def __init__(self, args):
         self.args = args
         self.task_dir = args.data_path
+        self.device = get_device(args)
 
         self.n_ent = 0
         self.n_rel = 0
@@ -250,56 +197,62 @@ class DataLoader_STITCH:
         self.relation2id = dict()
 
         # prepare triples
-        self.filters = defaultdict(lambda: set())
-
         self.BKG_list = BKG_list = args.BKG_list
-        self.fact_triple = self.read_BKG_triples(
-            BKG_list, max_triples=args.max_BKG_triples)
-        self.train_triple = self.read_triples(f'train.txt')
-        self.valid_triple = self.read_triples(f'valid.txt')
-        self.test_triple = self.read_triples(f'test.txt')
+        # the raw files are parsed once, later runs restore them from the binary cache in task_dir
+        BKG_sources = [os.path.join('../facts', filename) for filename in BKG_list]
+        sources = BKG_sources + ['train.txt', 'valid.txt', 'test.txt']
+        triples = load_cache(self, sources)
+        if triples is None:
+            triples = {source: self.read_BKG_file(filename) for source, filename in zip(BKG_sources, BKG_list)}
+            for filename in ['train.txt', 'valid.txt', 'test.txt']:
+                triples[filename] = self.read_triples(filename)
+            # known answers of the (head, rela) queries, plus the inverse (tail, rela + n_rel)
+            # queries of the train/valid/test triples
+            self.filters = FilterIndex.from_triples(TripleStore.concat(
+                [triples[source] for source in BKG_sources] + [TripleStore.concat(
+                    [triples['train.txt'], triples['valid.txt'], triples['test.txt']]).doubled(self.n_rel)]),
+                2*self.n_rel+1)
+            save_cache(self, sources, triples)
+
+        self.fact_triple = self.sample_BKG_triples(
+            [triples[source] for source in BKG_sources], max_triples=args.max_BKG_triples)
+        self.train_triple = triples['train.txt']
+        self.valid_triple = triples['valid.txt']
+        self.test_triple = triples['test.txt']
 
         self.id2entity = {v: k for k, v in self.entity2id.items()}
         self.id2relation = {v: k for k, v in self.relation2id.items()}
 
-        self.all_triple = np.concatenate(
-            [np.array(self.fact_triple), np.array(self.train_triple)], axis=0)
-        self.tmp_all_triple = np.concatenate([np.array(self.fact_triple), np.array(
-            self.train_triple), np.array(self.valid_triple), np.array(self.test_triple)], axis=0)
+        self.all_triple = TripleStore.concat(
+            [self.fact_triple, self.train_triple]).to_array(np.int32)
+        self.tmp_all_triple = TripleStore.concat(
+            [self.fact_triple, self.train_triple, self.valid_triple, self.test_triple]).to_array(np.int32)
 
-        self.add_reverse_relations(self.train_triple)
-        self.add_reverse_relations(self.valid_triple)
-        self.add_reverse_relations(self.test_triple)
-
-        self.fact_data = self.double_triple(self.fact_triple)
-        self.train_data = np.array(self.double_triple(self.train_triple))
-        self.valid_data = self.double_triple(self.valid_triple)
-        self.test_data = self.double_triple(self.test_triple)
+        self.valid_data = self.valid_triple.doubled(self.n_rel)
+        self.test_data = self.test_triple.doubled(self.n_rel)
 
+        self.splitter = TrainSplitter(self.all_triple, self.n_rel, self.n_ent, args.fact_ratio,
+                                      remove_1hop_edges=getattr(args, 'remove_1hop_edges', False),
+                                      background=getattr(args, 'async_shuffle', False))
         self.shuffle_train()
-        self.load_graph(self.fact_data)
-        self.load_test_graph(self.double_triple(
-            self.fact_triple)+self.double_triple(self.train_triple))
+        self.load_test_graph(TripleStore.concat(
+            [self.fact_triple.doubled(self.n_rel), self.train_triple.doubled(self.n_rel)]).to_array(np.int32))
         # self.load_test_graph(self.double_triple(self.train_triple))
         self.valid_q, self.valid_a = self.load_query(self.valid_data)
         self.test_q,  self.test_a = self.load_query(self.test_data)
+        # known answers of every valid/test query, for the filtered ranking
+        self.valid_filters = self.filters.query_filters(self.valid_q)
+        self.test_filters = self.filters.query_filters(self.test_q)
 
         self.n_train = len(self.train_data)
         self.n_valid = len(self.valid_q)
         self.n_test = len(self.test_q)
 
-        for filt in self.filters:
-            self.filters[filt] = list(self.filters[filt])
-
         print('n_train:', self.n_train, 'n_valid:', self.n_valid, 'n_test:',
               self.n_test, 'n_ent:', self.n_ent, 'n_rel:', self.n_rel)
 
-    def add_reverse_relations(self, triple_list):
-        for h_id, r_id, t_id in triple_list:
-            self.filters[(t_id, r_id + self.n_rel)].add(h_id)
-
     def read_triples(self, filename):
-        triples = []
+        triples = array('i')
         with open(os.path.join(self.task_dir, filename)) as f:
             for line in f:
                 h, r, t = line.strip().split()
@@ -320,189 +273,107 @@ class DataLoader_STITCH:
                 r_id = self.relation2id[r]
                 t_id = self.entity2id[t]
 
-                triples.append([h_id, r_id, t_id])
-                self.filters[(h_id, r_id)].add(t_id)
-                # self.filters[(t_id, r_id + self.n_rel)].add(h_id)
+                triples.extend((h_id, r_id, t_id))
 
-        return triples
+        return TripleStore.from_array(np.frombuffer(triples, dtype=np.intc))
 
-    def read_BKG_triples(self, filenames, max_triples=10000):
-        triples = []
-        for filename in filenames:
-            file_triples = []
-            with open(os.path.join(self.task_dir, '../facts', filename)) as f:
-                for line in f:
-                    h, r, t = line.strip().split('\t')
-                    if h not in self.entity2id:
-                        self.entity2id[h] = self.n_ent
-                        self.n_ent += 1
-
-                    if t not in self.entity2id:
-                        self.entity2id[t] = self.n_ent
-                        self.n_ent += 1
-
-                    if r not in self.relation2id:
-                        self.relation2id[r] = self.n_rel
-                        self.n_rel += 1
-
-                        h_id = self.entity2id[h]
-                        r_id = self.relation2id[r]
-                        t_id = self.entity2id[t]
-
-                        file_triples.append([h_id, r_id, t_id])
-                        self.filters[(h_id, r_id)].add(t_id)
-                        # self.filters[(t_id, r_id + self.n_rel)].add(h_id)
+    def read_BKG_file(self, filename):
+        file_triples = array('i')
+        with open(os.path.join(self.task_dir, '../facts', filename)) as f:
+            for line in f:
+                h, r, t = line.strip().split('\t')
+                if h not in self.entity2id:
+                    self.entity2id[h] = self.n_ent
+                    self.n_ent += 1
 
+                if t not in self.entity2id:
+                    self.entity2id[t] = self.n_ent
+                    self.n_ent += 1
+
+                if r not in self.relation2id:
+                    self.relation2id[r] = self.n_rel
+                    self.n_rel += 1
+
+                    h_id = self.entity2id[h]
+                    r_id = self.relation2id[r]
+                    t_id = self.entity2id[t]
+
+                    file_triples.extend((h_id, r_id, t_id))
+        return TripleStore.from_array(np.frombuffer(file_triples, dtype=np.intc))
+
+    def sample_BKG_triples(self, BKG_triples, max_triples=10000):
+        triples = []
+        for file_triples in BKG_triples:
             # If the number of triples exceeds the maximum limit, randomly sample the maximum number of triples
             if max_triples != -1 and len(file_triples) > max_triples:
-                file_triples = random.sample(file_triples, max_triples)
-
-            triples.extend(file_triples)
-        return triples
-
-    def double_triple(self, triples):
-        new_triples = []
-        for triple in triples:
-            h, r, t = triple
-            new_triples.append([t, r+self.n_rel, h])
-        return triples + new_triples
-
-    def load_graph(self, triples):
-        # (e, r', e)
-        # r' = 2 * n_rel, r' is manual generated and not exist in the original KG
-        # self.KG: shape=(self.n_fact, 3)
-        # M_sub shape=(self.n_fact, self.n_ent), store projection from head entity to triples
-        idd = np.concatenate([np.expand_dims(np.arange(self.n_ent), 1), 2*self.n_rel *
-                             np.ones((self.n_ent, 1)), np.expand_dims(np.arange(self.n_ent), 1)], 1)
-
-        self.KG = np.concatenate([np.array(triples), idd], 0)
-        self.n_fact = len(self.KG)
-        self.M_sub = csr_matrix((np.ones((self.n_fact,)), (np.arange(
-            self.n_fact), self.KG[:, 0])), shape=(self.n_fact, self.n_ent))
+                file_triples = file_triples[random.sample(range(len(file_triples)), max_triples)]
+
+            triples.append(file_triples)
+        return TripleStore.concat(triples)
 
     def load_test_graph(self, triples):
-        idd = np.concatenate([np.expand_dims(np.arange(self.n_ent), 1), 2*self.n_rel *
-                             np.ones((self.n_ent, 1)), np.expand_dims(np.arange(self.n_ent), 1)], 1)
+        idd = np.concatenate([np.expand_dims(np.arange(self.n_ent), 1), 2*self.n_rel*np.ones(
+            (self.n_ent, 1), dtype=np.int32), np.expand_dims(np.arange(self.n_ent), 1)], 1).astype(np.int32)
 
-        self.tKG = np.concatenate([np.array(triples), idd], 0)
-        self.tn_fact = len(self.tKG)
-        self.tM_sub = csr_matrix((np.ones((self.tn_fact,)), (np.arange(
-            self.tn_fact), self.tKG[:, 0])), shape=(self.tn_fact, self.n_ent))
+        # int32 as the train KG, widened only for the edges handed to torch
+        tKG = np.concatenate([np.array(triples, dtype=np.int32).reshape(-1, 3), idd], 0)
+        self.tn_fact = len(tKG)
+        self.tKG, self.tKG_offsets = build_head_index(tKG, self.n_ent)
 
     def load_query(self, triples):
-        trip_hr = defaultdict(lambda: list())
-
-        for trip in triples:
-            h, r, t = trip
-            trip_hr[(h, r)].append(t)
-
-        queries = []
-        answers = []
-        for key in trip_hr:
-            queries.append(key)
-            answers.append(np.array(trip_hr[key]))
-        return queries, answers
+        # group the answers of every (head, rela) query, in order of first appearance
+        # answers: QueryCSR of the sorted, distinct answers keyed by query id
+        queries, offsets, answers = triples.group_queries()
+        return queries, QueryCSR(offsets, answers.astype(np.int64))
 
     def get_neighbors(self, nodes, batchsize, mode='train'):
         if mode == 'train':
-            KG = self.KG  # [N_fact, 3] with (head, rela, tail)
-            M_sub = self.M_sub  # [N_fact, N_ent]
+            KG = self.KG  # [N_fact, 3] with (head, rela, tail), sorted by head
+            offsets = self.KG_offsets  # [N_ent+1]
         else:
             KG = self.tKG
-            M_sub = self.tM_sub
+            offsets = self.tKG_offsets
 
         # nodes: [N_ent_of_all_batch_last, 2] with (batch_idx, node_idx)
-        # [N_ent, N_ent_of_all_batch_last]
-        node_1hot = csr_matrix((np.ones(len(nodes)), (nodes[:, 1], nodes[:, 0])), shape=(
-            self.n_ent, nodes.shape[0]))
-        # [N_fact, N_ent] * [N_ent, N_ent_of_all_batch_last] -> [N_fact, N_ent_of_all_batch_last]
-        edge_1hot = M_sub.dot(node_1hot)
-        # [2, N_edge_of_all_batch] with (fact_idx, batch_idx)
-        edges = np.nonzero(edge_1hot)
-        # {batch_idx} + {head, rela, tail} -> concat -> [N_edge_of_all_batch, 4] with (batch_idx, head, rela, tail)
-        sampled_edges = np.concatenate(
-            [np.expand_dims(edges[1], 1), KG[edges[0]]], axis=1)
-        sampled_edges = torch.LongTensor(sampled_edges).cuda()
-
-        # indexing nodes | within/out of a batch | relative index
-        # note that node_idx is the absolute nodes idx in original KG
-        # head_nodes: [N_ent_of_all_batch_last, 2] with (batch_idx, node_idx)
-        # tail_nodes: [N_ent_of_all_batch_this, 2] with (batch_idx, node_idx)
-        # head_index: [N_edge_of_all_batch] with relative node idx
-        # tail_index: [N_edge_of_all_batch] with relative node idx
-        # head_nodes.shape: torch.Size([20, 2]) with (batch_idx, node_idx)
-        head_nodes, head_index = torch.unique(
-            sampled_edges[:, [0, 1]], dim=0, sorted=True, return_inverse=True)
-        # tail_nodes.shape: torch.Size([N_ent_of_all_batch_this, 2]) with (batch_idx, node_idx) 
-        tail_nodes, tail_index = torch.unique(
-            sampled_edges[:, [0, 3]], dim=0, sorted=True, return_inverse=True)
-
-        # [N_edge_of_all_batch, 4] -> [N_edge_of_all_batch, 6] with (batch_idx, head, rela, tail, head_index, tail_index)
-        # node that the head_index and tail_index are of this layer
-        sampled_edges = torch.cat(
-            [sampled_edges, head_index.unsqueeze(1), tail_index.unsqueeze(1)], 1)
-
-        # get new index for nodes in last layer
-        mask = sampled_edges[:, 2] == (self.n_rel*2)
-        old_nodes_new_idx = tail_index[mask].sort()[0]
-
-        return tail_nodes, sampled_edges, old_nodes_new_idx
-
-    def get_batch(self, batch_idx, steps=2, data='train'):
+        # gather the facts of each node through the head offsets
+        # -> [N_edge_of_all_batch, 4] with (batch_idx, head, rela, tail)
+        sampled_edges = gather_neighbors(KG, offsets, nodes)
+        sampled_edges = torch.LongTensor(sampled_edges).to(self.device)
+
+        return reindex_edges(sampled_edges, self.n_rel)
+
+    def get_batch(self, batch_idx, steps=2, data='train', dense=False):
         if data == 'train':
-            return np.array(self.train_data)[batch_idx]
+            return self.train_data[batch_idx]
         if data == 'valid':
-            query, answer = np.array(self.valid_q), np.array(
-                self.valid_a, dtype=object)
+            query, answer = self.valid_q, self.valid_a
         if data == 'test':
-            query, answer = np.array(self.test_q), np.array(
-                self.test_a, dtype=object)
-
+            query, answer = self.test_q, self.test_a
         subs = query[batch_idx, 0]
         rels = query[batch_idx, 1]
-        objs = np.zeros((len(batch_idx), self.n_ent))
-        for i in range(len(batch_idx)):
-            objs[i][answer[batch_idx[i]]] = 1
-
-        if data != 'train':
-            nonzero_indices = np.nonzero(objs)
-            rows = nonzero_indices[0]
-            num = []
-            unique_rows, counts = np.unique(rows, return_counts=True)
-            num = list(counts)
-            return subs, rels, objs, num
+        # objs: (rows, answers) of the batch, rows index into batch_idx
+        objs = answer.gather(batch_idx)
+        num = list(answer.counts(batch_idx))
 
-        return subs, rels, objs
+        # dense [batch_size, n_ent] label matrix, only built on request
+        if dense:
+            labels = np.zeros((len(batch_idx), self.n_ent))
+            labels[objs] = 1
+            objs = labels
+        return subs, rels, objs, num
 
     def shuffle_train(self):
-        all_triple = self.all_triple
-        n_all = len(all_triple)
-        rand_idx = np.random.permutation(n_all)
-        all_triple = all_triple[rand_idx]
-
-        bar = int(n_all * self.args.fact_ratio)
-        self.fact_data = np.array(
-            self.double_triple(all_triple[:bar].tolist()))
-        self.train_data = np.array(
-            self.double_triple(all_triple[bar:].tolist()))
-
-        if hasattr(self.args, 'remove_1hop_edges') and self.args.remove_1hop_edges:
-            print('==> removing 1-hop links...')
-            tmp_index = np.ones((self.n_ent, self.n_ent))
-            tmp_index[self.train_data[:, 0], self.train_data[:, 2]] = 0
-            save_facts = tmp_index[self.fact_data[:, 0],
-                                   self.fact_data[:, 2]].astype(bool)
-            self.fact_data = self.fact_data[save_facts]
-            print('==> done')
-
+        # re-split fact/train triples, the fact graph is compacted from the head-sorted index
+        self.KG, self.KG_offsets, self.train_data = self.splitter.next_split()
+        self.n_fact = len(self.KG)
         self.n_train = len(self.train_data)
-        self.load_graph(self.fact_data)
 
 
 class DataLoader_UMLS:
     def __init__(self, args):
         self.args = args
         self.task_dir = task_dir = args.data_path
+        self.device = get_device(args)
 
         with open(os.path.join(task_dir, 'entities.txt')) as f:
             self.entity2id = dict()
@@ -524,188 +395,114 @@ class DataLoader_UMLS:
         self.n_rel = n_rel
 
         # prepare triples
-        self.filters = defaultdict(lambda: set())
-        self.fact_triple = self.read_triples('facts.txt')
-        self.train_triple = self.read_triples('train.txt')
-        self.valid_triple = self.read_triples('valid.txt')
-        self.test_triple = self.read_triples('test.txt')
+        # the raw files are parsed once, later runs restore them from the binary cache in task_dir
+        sources = ['entities.txt', 'relations.txt', 'facts.txt', 'train.txt', 'valid.txt', 'test.txt']
+        triples = load_cache(self, sources)
+        if triples is None:
+            triples = {filename: self.read_triples(filename) for filename in sources[2:]}
+            # known answers of the (head, rela) and the inverse (tail, rela + n_rel) queries
+            self.filters = FilterIndex.from_triples(
+                TripleStore.concat(triples.values()).doubled(self.n_rel), 2*self.n_rel+1)
+            save_cache(self, sources, triples)
+
+        self.fact_triple = triples['facts.txt']
+        self.train_triple = triples['train.txt']
+        self.valid_triple = triples['valid.txt']
+        self.test_triple = triples['test.txt']
 
         self.id2entity = {v: k for k, v in self.entity2id.items()}
         self.id2relation = {v: k for k, v in self.relation2id.items()}
 
-        self.all_triple = np.concatenate(
-            [np.array(self.fact_triple), np.array(self.train_triple)], axis=0)
-        self.tmp_all_triple = np.concatenate([np.array(self.fact_triple), np.array(
-            self.train_triple), np.array(self.valid_triple), np.array(self.test_triple)], axis=0)
+        self.all_triple = TripleStore.concat(
+            [self.fact_triple, self.train_triple]).to_array(np.int32)
+        self.tmp_all_triple = TripleStore.concat(
+            [self.fact_triple, self.train_triple, self.valid_triple, self.test_triple]).to_array(np.int32)
 
         # add inverse
-        self.fact_data = self.double_triple(self.fact_triple)
-        self.train_data = np.array(self.double_triple(self.train_triple))
-        self.valid_data = self.double_triple(self.valid_triple)
-        self.test_data = self.double_triple(self.test_triple)
+        self.valid_data = self.valid_triple.doubled(self.n_rel)
+        self.test_data = self.test_triple.doubled(self.n_rel)
 
+        self.splitter = TrainSplitter(self.all_triple, self.n_rel, self.n_ent, args.fact_ratio,
+                                      remove_1hop_edges=getattr(args, 'remove_1hop_edges', False),
+                                      background=getattr(args, 'async_shuffle', False))
         self.shuffle_train()
-        self.load_graph(self.fact_data)
-        self.load_test_graph(self.double_triple(
-            self.fact_triple)+self.double_triple(self.train_triple))
+        self.load_test_graph(TripleStore.concat(
+            [self.fact_triple.doubled(self.n_rel), self.train_triple.doubled(self.n_rel)]).to_array(np.int32))
         self.valid_q, self.valid_a = self.load_query(self.valid_data)
         self.test_q,  self.test_a = self.load_query(self.test_data)
+        # known answers of every valid/test query, for the filtered ranking
+        self.valid_filters = self.filters.query_filters(self.valid_q)
+        self.test_filters = self.filters.query_filters(self.test_q)
 
         self.n_train = len(self.train_data)
         self.n_valid = len(self.valid_q)
         self.n_test = len(self.test_q)
 
-        for filt in self.filters:
-            self.filters[filt] = list(self.filters[filt])
-
         print('n_train:', self.n_train, 'n_valid:',
               self.n_valid, 'n_test:', self.n_test)
 
     def read_triples(self, filename):
-        triples = []
+        triples = array('i')
         with open(os.path.join(self.task_dir, filename)) as f:
             for line in f:
                 h, r, t = line.strip().split()
                 h, r, t = self.entity2id[h], self.relation2id[r], self.entity2id[t]
-                triples.append([h, r, t])
-                self.filters[(h, r)].add(t)
-                self.filters[(t, r+self.n_rel)].add(h)
-        return triples
-
-    def double_triple(self, triples):
-        new_triples = []
-        for triple in triples:
-            h, r, t = triple
-            new_triples.append([t, r+self.n_rel, h])
-        return triples + new_triples
-
-    def load_graph(self, triples):
-        # (e, r', e)
-        # r' = 2 * n_rel, r' is manual generated and not exist in the original KG
-        # self.KG: shape=(self.n_fact, 3)
-        # M_sub shape=(self.n_fact, self.n_ent), store projection from head entity to triples
-        idd = np.concatenate([np.expand_dims(np.arange(self.n_ent), 1), 2*self.n_rel*np.ones(
-            (self.n_ent, 1)), np.expand_dims(np.arange(self.n_ent), 1)], 1)  # identity triples
-
-        self.KG = np.concatenate([np.array(triples), idd], 0)
-        self.n_fact = len(self.KG)
-        self.M_sub = csr_matrix((np.ones((self.n_fact,)), (np.arange(self.n_fact), self.KG[:, 0])), shape=(
-            self.n_fact, self.n_ent))  
+                triples.extend((h, r, t))
+        return TripleStore.from_array(np.frombuffer(triples, dtype=np.intc))
 
     def load_test_graph(self, triples):
-        idd = np.concatenate([np.expand_dims(np.arange(self.n_ent), 1), 2*self.n_rel *
-                             np.ones((self.n_ent, 1)), np.expand_dims(np.arange(self.n_ent), 1)], 1)
+        idd = np.concatenate([np.expand_dims(np.arange(self.n_ent), 1), 2*self.n_rel*np.ones(
+            (self.n_ent, 1), dtype=np.int32), np.expand_dims(np.arange(self.n_ent), 1)], 1).astype(np.int32)
 
-        self.tKG = np.concatenate([np.array(triples), idd], 0)
-        self.tn_fact = len(self.tKG)
-        self.tM_sub = csr_matrix((np.ones((self.tn_fact,)), (np.arange(
-            self.tn_fact), self.tKG[:, 0])), shape=(self.tn_fact, self.n_ent))
+        # int32 as the train KG, widened only for the edges handed to torch
+        tKG = np.concatenate([np.array(triples, dtype=np.int32).reshape(-1, 3), idd], 0)
+        self.tn_fact = len(tKG)
+        self.tKG, self.tKG_offsets = build_head_index(tKG, self.n_ent)
 
     def load_query(self, triples):
-        trip_hr = defaultdict(lambda: list())
-
-        for trip in triples:
-            h, r, t = trip
-            trip_hr[(h, r)].append(t)
-
-        queries = []
-        answers = []
-        for key in trip_hr:
-            queries.append(key)
-            answers.append(np.array(trip_hr[key]))
-        return queries, answers
+        # group the answers of every (head, rela) query, in order of first appearance
+        # answers: QueryCSR of the sorted, distinct answers keyed by query id
+        queries, offsets, answers = triples.group_queries()
+        return queries, QueryCSR(offsets, answers.astype(np.int64))
 
     def get_neighbors(self, nodes, batchsize, mode='train'):
         if mode == 'train':
-            KG = self.KG
-            M_sub = self.M_sub
+            KG = self.KG  # [N_fact, 3] with (head, rela, tail), sorted by head
+            offsets = self.KG_offsets  # [N_ent+1]
         else:
             KG = self.tKG
-            M_sub = self.tM_sub
+            offsets = self.tKG_offsets
 
         # nodes: [N_ent_of_all_batch_last, 2] with (batch_idx, node_idx)
-        # [N_ent, N_ent_of_all_batch_last]
-        node_1hot = csr_matrix((np.ones(len(nodes)), (nodes[:, 1], nodes[:, 0])), shape=(
-            self.n_ent, nodes.shape[0]))
-        # [N_fact, N_ent] * [N_ent, N_ent_of_all_batch_last] -> [N_fact, N_ent_of_all_batch_last]
-        edge_1hot = M_sub.dot(node_1hot)
-        # [2, N_edge_of_all_batch] with (fact_idx, batch_idx)
-        edges = np.nonzero(edge_1hot)
-        # {batch_idx} + {head, rela, tail} -> concat -> [N_edge_of_all_batch, 4] with (batch_idx, head, rela, tail)
-        sampled_edges = np.concatenate(
-            [np.expand_dims(edges[1], 1), KG[edges[0]]], axis=1)
-        sampled_edges = torch.LongTensor(sampled_edges).cuda()
-
-        # indexing nodes | within/out of a batch | relative index
-        # note that node_idx is the absolute nodes idx in original KG
-        # head_nodes: [N_ent_of_all_batch_last, 2] with (batch_idx, node_idx)
-        # tail_nodes: [N_ent_of_all_batch_this, 2] with (batch_idx, node_idx)
-        # head_index: [N_edge_of_all_batch] with relative node idx
-        # tail_index: [N_edge_of_all_batch] with relative node idx
-        head_nodes, head_index = torch.unique(
-            sampled_edges[:, [0, 1]], dim=0, sorted=True, return_inverse=True)
-        tail_nodes, tail_index = torch.unique(
-            sampled_edges[:, [0, 3]], dim=0, sorted=True, return_inverse=True)
-
-        # [N_edge_of_all_batch, 4] -> [N_edge_of_all_batch, 6] with (batch_idx, head, rela, tail, head_index, tail_index)
-        # node that the head_index and tail_index are of this layer
-        sampled_edges = torch.cat(
-            [sampled_edges, head_index.unsqueeze(1), tail_index.unsqueeze(1)], 1)
-
-        # get new index for nodes in last layer
-        mask = sampled_edges[:, 2] == (self.n_rel*2)
-        # old_nodes_new_idx: [N_ent_of_all_batch_last]
-        old_nodes_new_idx = tail_index[mask].sort()[0]
-
-        return tail_nodes, sampled_edges, old_nodes_new_idx
-
-    def get_batch(self, batch_idx, steps=2, data='train'):
+        # gather the facts of each node through the head offsets
+        # -> [N_edge_of_all_batch, 4] with (batch_idx, head, rela, tail)
+        sampled_edges = gather_neighbors(KG, offsets, nodes)
+        sampled_edges = torch.LongTensor(sampled_edges).to(self.device)
+
+        return reindex_edges(sampled_edges, self.n_rel)
+
+    def get_batch(self, batch_idx, steps=2, data='train', dense=False):
         if data == 'train':
-            return np.array(self.train_data)[batch_idx]
+            return self.train_data[batch_idx]
         if data == 'valid':
-            query, answer = np.array(self.valid_q), np.array(
-                self.valid_a, dtype=object)
+            query, answer = self.valid_q, self.valid_a
         if data == 'test':
-            query, answer = np.array(self.test_q), np.array(
-                self.test_a, dtype=object)
-        subs = []
-        rels = []
-        objs = []
+            query, answer = self.test_q, self.test_a
         subs = query[batch_idx, 0]
         rels = query[batch_idx, 1]
-        objs = np.zeros((len(batch_idx), self.n_ent))
-        for i in range(len(batch_idx)):
-            objs[i][answer[batch_idx[i]]] = 1
-        if data != 'train':
-            nonzero_indices = np.nonzero(objs)
-            rows = nonzero_indices[0]
-            num = []
-            unique_rows, counts = np.unique(rows, return_counts=True)
-            num = list(counts)
-            return subs, rels, objs, num
-        return subs, rels, objs
+        # objs: (rows, answers) of the batch, rows index into batch_idx
+        objs = answer.gather(batch_idx)
+        num = list(answer.counts(batch_idx))
 
-    def shuffle_train(self):
-        all_triple = self.all_triple
-        n_all = len(all_triple)
-        rand_idx = np.random.permutation(n_all)
-        all_triple = all_triple[rand_idx]
-
-        bar = int(n_all * self.args.fact_ratio)
-        self.fact_data = np.array(
-            self.double_triple(all_triple[:bar].tolist()))
-        self.train_data = np.array(
-            self.double_triple(all_triple[bar:].tolist()))
-
-        if hasattr(self.args, 'remove_1hop_edges') and self.args.remove_1hop_edges:
-            # if self.args.remove_1hop_edges:
-            print('==> removing 1-hop links...')
-            tmp_index = np.ones((self.n_ent, self.n_ent))
-            tmp_index[self.train_data[:, 0], self.train_data[:, 2]] = 0
-            save_facts = tmp_index[self.fact_data[:, 0],
-                                   self.fact_data[:, 2]].astype(bool)
-            self.fact_data = self.fact_data[save_facts]
-            print('==> done')
+        # dense [batch_size, n_ent] label matrix, only built on request
+        if dense:
+            labels = np.zeros((len(batch_idx), self.n_ent))
+            labels[objs] = 1
+            objs = labels
+        return subs, rels, objs, num
 
+    def shuffle_train(self):
+        # re-split fact/train triples, the fact graph is compacted from the head-sorted index
+        self.KG, self.KG_offsets, self.train_data = self.splitter.next_split()
+        self.n_fact = len(self.KG)
         self.n_train = len(self.train_data)
-        self.load_graph(self.fact_data)
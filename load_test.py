@@ -0,0 +1,68 @@
+# -*- coding:utf-8 -*-
+import argparse
+import asyncio
+import json
+import time
+
+import numpy as np
+
+
+''' load test of the serve.py endpoint: throughput and latency percentiles of concurrent clients '''
+parser = argparse.ArgumentParser(description="Load test of the BioGraphFusion prediction service")
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8080)
+parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32], help='Concurrent clients, one keep-alive connection each')
+parser.add_argument('--requests', type=int, default=500, help='Requests per concurrency level')
+parser.add_argument('--k', type=int, default=10)
+
+
+async def request(reader, writer, method, path, payload=None):
+    # one request on a keep-alive connection, returns (status, decoded JSON body)
+    body = json.dumps(payload).encode() if payload is not None else b''
+    writer.write(b'%s %s HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+                 % (method.encode(), path.encode(), len(body)) + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        if name.strip().lower() == 'content-length':
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length))
+
+
+async def client(args, queries, latencies, errors):
+    # sends the queries it takes from the shared list one after another
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    while queries:
+        head, relation = queries.pop()
+        t = time.time()
+        status, _ = await request(reader, writer, 'POST', '/predict', {'head': head, 'relation': relation, 'k': args.k})
+        latencies.append(time.time() - t)
+        errors += [status] if status != 200 else []
+    writer.close()
+
+
+async def main(args):
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    _, samples = await request(reader, writer, 'GET', '/sample?n=%d' % args.requests)
+    for concurrency in args.concurrency:
+        _, before = await request(reader, writer, 'GET', '/stats')
+        queries, latencies, errors = list(samples), [], []
+        t = time.time()
+        await asyncio.gather(*[client(args, queries, latencies, errors) for _ in range(concurrency)])
+        t = time.time() - t
+        _, after = await request(reader, writer, 'GET', '/stats')
+        batch = (after['served'] - before['served']) / max(after['batches'] - before['batches'], 1)
+        p50, p90, p99 = np.percentile(np.array(latencies) * 1000, [50, 90, 99])
+        print('concurrency:%d\t %.1f requests/s latency p50:%.1fms p90:%.1fms p99:%.1fms max:%.1fms'
+              ' server batch:%.1f errors:%d'
+              % (concurrency, len(latencies) / t, p50, p90, p99, max(latencies) * 1000, batch, len(errors)))
+    writer.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parser.parse_args()))
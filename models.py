@@ -8,11 +8,39 @@ from torch_scatter import scatter
 from collections import defaultdict
 # from Refinement import Refinement
 from relation_refinement import Refinement,N3
+from kg_index import DeviceNeighbors
+from utils import get_device
 import os
 import networkx as nx
 os.environ['CUDA_LAUNCH_BLOCKING'] = "1"
 
 
+def segment_softmax(x, index, n_seg):
+    # softmax of x within the segments given by index, e.g. the visited nodes of each query
+    # x, index: [N], returns [N]
+    x_max = scatter(x.detach(), index=index, dim=0, dim_size=n_seg, reduce='max')
+    x_exp = torch.exp(x - x_max[index])
+    return x_exp / scatter(x_exp, index=index, dim=0, dim_size=n_seg, reduce='sum')[index]
+
+
+def gumbel_segment_softmax(x, index, n_seg, tau=1.0):
+    # F.gumbel_softmax(hard=False) within segments
+    gumbels = -torch.empty_like(x).exponential_().log()
+    return segment_softmax((x + gumbels) / tau, index, n_seg)
+
+
+def segment_topk(x, index, n_seg, k):
+    # boolean mask of the k largest x within each segment, ties broken by position
+    # x, index: [N], returns [N]
+    # torch.sort, torch.argsort only takes stable from torch 1.13 on
+    order = torch.sort(x, descending=True, stable=True)[1]
+    order = order[torch.sort(index[order], stable=True)[1]]
+    counts = torch.bincount(index, minlength=n_seg)
+    starts = torch.cumsum(counts, 0) - counts
+    rank = torch.arange(len(x), device=x.device) - starts[index[order]]
+    mask = torch.zeros(len(x), dtype=torch.bool, device=x.device)
+    mask[order] = rank < k
+    return mask
 
 
 class GNNLayer(torch.nn.Module):
@@ -29,58 +57,59 @@ class GNNLayer(torch.nn.Module):
         self.n_edge_topk = n_edge_topk
         self.tau = tau
         self.rela_embed = emb_model
-        self.Ws_attn = nn.Linear(in_dim, attn_dim, bias=False).cuda()
-        self.Wr_attn = nn.Linear(in_dim, attn_dim, bias=False).cuda()
-        self.Wo_attn     = nn.Linear(in_dim, attn_dim, bias=False).cuda()
-        self.Wqr_attn = nn.Linear(in_dim, attn_dim).cuda()
-        self.w_alpha = nn.Linear(attn_dim, 1).cuda()
-        self.W_h = nn.Linear(in_dim, out_dim, bias=False).cuda()
-        self.W_o       = nn.Linear(in_dim, out_dim, bias=False).cuda()
-        self.W_samp = nn.Linear(in_dim, 1, bias=False).cuda()
+        self.Ws_attn = nn.Linear(in_dim, attn_dim, bias=False)
+        self.Wr_attn = nn.Linear(in_dim, attn_dim, bias=False)
+        self.Wo_attn     = nn.Linear(in_dim, attn_dim, bias=False)
+        self.Wqr_attn = nn.Linear(in_dim, attn_dim)
+        self.w_alpha = nn.Linear(attn_dim, 1)
+        self.W_h = nn.Linear(in_dim, out_dim, bias=False)
+        self.W_o       = nn.Linear(in_dim, out_dim, bias=False)
+        self.W_samp = nn.Linear(in_dim, 1, bias=False)
 
     def train(self, mode=True):
         if not isinstance(mode, bool):
             raise ValueError("training mode is expected to be boolean")
         self.training = mode
         if self.training and self.tau > 0:
-            self.softmax = lambda x: F.gumbel_softmax(x, tau=self.tau, hard=False)
+            self.softmax = lambda x, index, n_seg: gumbel_segment_softmax(x, index, n_seg, tau=self.tau)
         else:
-            self.softmax = lambda x: F.softmax(x, dim=1)
+            self.softmax = segment_softmax
         for module in self.children():
             module.train(mode)
         return self
 
+    def edge_attention(self, q_sub, q_rel, hidden, edges):
+        # Ws_attn(hs) + Wr_attn(hr) + Wqr_attn(h_qr) and the message hs + hr of every edge, with each
+        # projection applied once per node / (head, relation) pair / query and then gathered onto the edges
+        # returns attn: [N_edge_of_all_batch, attn_dim], message: [N_edge_of_all_batch, dim]
+        sub = edges[:, 4]
+        r_idx = edges[:, 0]
+        hr, pair_idx = self.rela_embed.pairs(edges[:, 1], edges[:, 2])  # [N_pair, dim], [N_edge_of_all_batch]
+        h_qr = self.rela_embed(q_sub, q_rel)  # [B, dim]
+        attn = self.Ws_attn(hidden)[sub] + self.Wr_attn(hr)[pair_idx] + self.Wqr_attn(h_qr)[r_idx]
+        message = hidden[sub] + hr[pair_idx]
+        return attn, message
+
     def forward(self, q_sub, q_rel, hidden, edges, nodes, old_nodes_new_idx, batchsize):
         # edges: [N_edge_of_all_batch, 6]
         # with (batch_idx, head, rela, tail, head_idx, tail_idx)
         # note that head_idx and tail_idx are relative index
-        sub = edges[:, 4]
-        rel = edges[:, 2]
         obj = edges[:, 5]
-        hs = hidden[sub]
-        hr = self.rela_embed(edges[:, 1], rel)
-
-        r_idx = edges[:, 0]
-
-        h_qr = self.rela_embed(q_sub, q_rel)[r_idx]
         n_node = nodes.shape[0]
-        message = hs + hr
-
-        ho = self.rela_embed.lhs(edges[:, 3])
+        attn, message = self.edge_attention(q_sub, q_rel, hidden, edges)
 
         # sample edges w.r.t. alpha
         if self.n_edge_topk > 0:
-            alpha = self.w_alpha(nn.ReLU()(self.Ws_attn(hs) + self.Wr_attn(hr) + self.Wqr_attn(h_qr))).squeeze(-1)
+            alpha = self.w_alpha(nn.ReLU()(attn)).squeeze(-1).float()  # gumbel sampling in fp32 under autocast
             edge_prob = F.gumbel_softmax(alpha, tau=1, hard=False)
             topk_index = torch.argsort(edge_prob, descending=True)[:self.n_edge_topk]
-            edge_prob_hard = torch.zeros((alpha.shape[0])).cuda()
+            edge_prob_hard = torch.zeros((alpha.shape[0]), device=alpha.device)
             edge_prob_hard[topk_index] = 1
             alpha *= (edge_prob_hard - edge_prob.detach() + edge_prob)
             alpha = torch.sigmoid(alpha).unsqueeze(-1)
 
         else:
-            alpha = torch.sigmoid(self.w_alpha(nn.ReLU()(self.Ws_attn(hs) + self.Wr_attn(hr) + self.Wqr_attn(
-                h_qr))))  # [N_edge_of_all_batch, 1]
+            alpha = torch.sigmoid(self.w_alpha(nn.ReLU()(attn)))  # [N_edge_of_all_batch, 1]
 
         # aggregate message and then propagate
         message = alpha * message  # [rel.shape[0],dim]
@@ -92,39 +121,30 @@ class GNNLayer(torch.nn.Module):
 
         # forward without node sampling
         if self.n_node_topk <= 0:
-            return hidden_new,nodes,torch.ones(n_node).bool()
+            return hidden_new,nodes,torch.ones(n_node, dtype=torch.bool, device=hidden_new.device)
 
         # forward with node sampling
         # indexing sampling operation
-        tmp_diff_node_idx = torch.ones(n_node)
-        tmp_diff_node_idx[old_nodes_new_idx] = 0
-        bool_diff_node_idx = tmp_diff_node_idx.bool()
-        diff_node = nodes[bool_diff_node_idx]
-
-        # project logit to fixed-size tensor via indexing
-        diff_node_logit = self.W_samp(hidden_new[bool_diff_node_idx]).squeeze(-1)  # [all_batch_new_nodes]
-
-        # save logit to node_scores for later indexing
-        node_scores = torch.ones((batchsize, self.n_ent)).cuda() * float('-inf')
-        node_scores[diff_node[:, 0], diff_node[:, 1]] = diff_node_logit  # [batchsize, n_ent]
-
-        # select top-k nodes
-        # (train mode) self.softmax == F.gumbel_softmax
-        # (eval mode)  self.softmax == F.softmax
-        node_scores = self.softmax(node_scores)  # [batchsize, n_ent]
-        topk_index = torch.topk(node_scores, self.n_node_topk, dim=1).indices.reshape(-1)
-        topk_batchidx = torch.arange(batchsize).repeat(self.n_node_topk, 1).T.reshape(-1)
-        batch_topk_nodes = torch.zeros((batchsize, self.n_ent)).cuda() # [batchsize, n_ent]
-        batch_topk_nodes[topk_batchidx, topk_index] = 1
+        bool_diff_node_idx = torch.ones(n_node, dtype=torch.bool, device=hidden_new.device)
+        bool_diff_node_idx[old_nodes_new_idx] = False
+        diff_node = nodes[bool_diff_node_idx]  # diff_node[:,0]:batch_idx  diff_node[:,1]:node_idx
+
+        # logits of the newly visited nodes only, grouped by batch_idx instead of a [batchsize, n_ent] table
+        # fp32 even under autocast, the (gumbel) softmax and top-k are sensitive to rounding
+        diff_node_logit = self.W_samp(hidden_new[bool_diff_node_idx]).squeeze(-1).float()  # [all_batch_new_nodes]
+
+        # select top-k nodes within each query's visited nodes
+        # (train mode) self.softmax == gumbel_segment_softmax
+        # (eval mode)  self.softmax == segment_softmax
+        diff_node_prob = self.softmax(diff_node_logit, diff_node[:, 0], batchsize)  # [all_batch_new_nodes]
+        bool_sampled_diff_nodes_idx = segment_topk(diff_node_prob, diff_node[:, 0], batchsize, self.n_node_topk)
 
         # get sampled nodes' relative index
-        bool_sampled_diff_nodes_idx = batch_topk_nodes[diff_node[:, 0], diff_node[:,1]].bool()  # diff_node    diff_node[:,0]:batch_idx  diff_node[:,1]:node_idx
-        bool_same_node_idx = ~bool_diff_node_idx.cuda()
+        bool_same_node_idx = ~bool_diff_node_idx
         bool_same_node_idx[bool_diff_node_idx] = bool_sampled_diff_nodes_idx
 
         # update node embeddings
-        diff_node_prob_hard = batch_topk_nodes[diff_node[:, 0], diff_node[:, 1]]
-        diff_node_prob = node_scores[diff_node[:, 0], diff_node[:, 1]]
+        diff_node_prob_hard = bool_sampled_diff_nodes_idx.float()
         hidden_new[bool_diff_node_idx] *= (diff_node_prob_hard - diff_node_prob.detach() + diff_node_prob).unsqueeze(
             -1)
 
@@ -135,7 +155,96 @@ class GNNLayer(torch.nn.Module):
         return hidden_new, new_nodes, bool_same_node_idx
 
 
-
+class SparseScores(object):
+    # scores of the visited nodes of a batch, every other entity implicitly scores `default`
+    # batch_idx, entity_idx, score: [N_visited], as in nodes[:, 0], nodes[:, 1] of the last layer
+    def __init__(self, batch_idx, entity_idx, score, n_query, n_ent, default=0.):
+        self.batch_idx = batch_idx
+        self.entity_idx = entity_idx
+        self.score = score
+        self.n_query = n_query
+        self.n_ent = n_ent
+        self.default = default
+
+    def __len__(self):
+        return len(self.score)
+
+    def to_dense(self):
+        # [n_query, n_ent], the scores_all of the dense forward
+        scores_all = torch.full((self.n_query, self.n_ent), self.default, dtype=self.score.dtype,
+                                device=self.score.device)
+        scores_all[self.batch_idx, self.entity_idx] = self.score
+        return scores_all
+
+    def cross_entropy(self, targets):
+        # the dense loss sum(-pos + max + log(sum(exp(scores - max)))) from the visited scores alone,
+        # the n_ent - visited entities at the default score adding (n_ent - visited) * exp(default - max)
+        # targets: [n_query] answer entity of each query
+        n_unvisited = self.n_ent - torch.bincount(self.batch_idx, minlength=self.n_query)
+        row_max = scatter(self.score.detach(), index=self.batch_idx, dim=0, dim_size=self.n_query, reduce='max')
+        row_max = torch.where(n_unvisited > 0, row_max.clamp(min=self.default), row_max)
+        sum_exp = scatter(torch.exp(self.score - row_max[self.batch_idx]), index=self.batch_idx, dim=0,
+                          dim_size=self.n_query, reduce='sum')
+        sum_exp = sum_exp + n_unvisited * torch.exp(self.default - row_max)
+
+        is_target = self.entity_idx == targets[self.batch_idx]
+        pos_scores = scatter(self.score * is_target, index=self.batch_idx, dim=0, dim_size=self.n_query,
+                             reduce='sum')
+        found = scatter(is_target.long(), index=self.batch_idx, dim=0, dim_size=self.n_query, reduce='sum') > 0
+        pos_scores = torch.where(found, pos_scores, torch.full_like(pos_scores, self.default))
+        return torch.sum(- pos_scores + row_max + torch.log(sum_exp))
+
+    def numpy(self):
+        # (rows, cols, values) on host, the form taken by cal_ranks_sparse
+        return (self.batch_idx.cpu().numpy(), self.entity_idx.cpu().numpy(),
+                self.score.detach().cpu().numpy())
+
+    def topk(self, k):
+        # [n_query, k] entity ids and scores in descending order, as numpy arrays; unvisited entities enter
+        # with the default score, lowest ids first and ahead of visited ones scoring the same
+        # one segment sort, as in segment_topk, of the visited scores and the lowest unvisited ids of each query
+        k = min(k, self.n_ent)
+        device = self.score.device
+        # the k lowest unvisited ids of a query are below its number of visited nodes + k: mark the visited ones
+        # in a buffer of these ranges of all queries, and keep the first k unmarked of each
+        n_visited = torch.bincount(self.batch_idx, minlength=self.n_query)
+        n_low = torch.clamp(n_visited + k, max=self.n_ent)
+        low_starts = torch.cumsum(n_low, 0) - n_low
+        low_rows = torch.repeat_interleave(torch.arange(self.n_query, device=device), n_low)
+        low_ent = torch.arange(len(low_rows), device=device) - low_starts[low_rows]
+        visited = torch.zeros(len(low_rows), dtype=torch.bool, device=device)
+        low = self.entity_idx < n_low[self.batch_idx]
+        visited[low_starts[self.batch_idx[low]] + self.entity_idx[low]] = True
+        unvisited = (~visited).long()
+        n_unvisited = torch.cumsum(unvisited, 0)  # up to and including each id, counted from the first query
+        n_unvisited = n_unvisited - (n_unvisited - unvisited)[low_starts][low_rows]
+        fill = ~visited & (n_unvisited <= k)
+
+        # visited candidates: the ones scoring at least the k-th best visited score of their query, from a
+        # [n_query, max visited] padding of the scores (the model returns the nodes grouped by query)
+        rows, ents, values = self.batch_idx, self.entity_idx, self.score.detach()
+        if len(rows) > 0:
+            by_row = None if bool((rows[1:] >= rows[:-1]).all()) else torch.sort(rows, stable=True)[1]
+            grouped = rows if by_row is None else rows[by_row]
+            slot = torch.arange(len(rows), device=device) - (torch.cumsum(n_visited, 0) - n_visited)[grouped]
+            padded = torch.full((self.n_query, int(n_visited.max())), -float('inf'), dtype=values.dtype, device=device)
+            padded[grouped, slot] = values if by_row is None else values[by_row]
+            kth = padded.topk(min(k, padded.shape[1]), 1)[0][:, -1]
+            keep = values >= kth[rows]
+            rows, ents, values = rows[keep], ents[keep], values[keep]
+
+        # unvisited first, so that the stable sorts keep them ahead of visited ties
+        rows = torch.cat([low_rows[fill], rows])
+        ents = torch.cat([low_ent[fill], ents])
+        values = torch.cat([torch.full((int(fill.sum()),), self.default, dtype=values.dtype, device=device), values])
+        order = torch.sort(values, descending=True, stable=True)[1]
+        order = order[torch.sort(rows[order], stable=True)[1]]
+        counts = torch.bincount(rows, minlength=self.n_query)
+        starts = torch.cumsum(counts, 0) - counts
+        rank = torch.arange(len(order), device=device) - starts[rows[order]]
+        # every query has at least k candidates, its first k in row order
+        top = order[rank < k]
+        return ents[top].view(self.n_query, k).cpu().numpy(), values[top].view(self.n_query, k).cpu().numpy()
 
 
 class GNNModel(torch.nn.Module):
@@ -150,6 +259,9 @@ class GNNModel(torch.nn.Module):
         self.n_node_topk = params.n_node_topk
         self.n_edge_topk = params.n_edge_topk
         self.loader = loader
+        self.device = get_device(params)
+        # expand neighbors with tensor ops on the model's device instead of through the loader on host
+        self.device_neighbors = DeviceNeighbors(loader) if getattr(params, 'device_neighbors', False) else None
         self.lossflag = params.lossflag
         if params.lossflag:
             self.regFlag     = params.Flag
@@ -173,10 +285,10 @@ class GNNModel(torch.nn.Module):
 
         self.gnn_layers = nn.ModuleList(self.gnn_layers)
         self.dropout = nn.Dropout(params.dropout)
-        self.W_final = nn.Linear(self.hidden_dim, 1, bias=False).cuda()
+        self.W_final = nn.Linear(self.hidden_dim, 1, bias=False)
         self.lamda=params.lamda
         if (params.gate == 'GRU'):
-            self.gate = nn.GRU(self.hidden_dim, self.hidden_dim).cuda()
+            self.gate = nn.GRU(self.hidden_dim, self.hidden_dim)
         else:
             self.gate = nn.LSTM(self.hidden_dim, self.hidden_dim)
 
@@ -194,25 +306,31 @@ class GNNModel(torch.nn.Module):
 
 
 
-    def forward(self, subs, rels, mode='train'):
+    def forward(self, subs, rels, mode='train', sparse=False):
+        # sparse: return the scores as SparseScores of the visited nodes instead of a dense [B, n_ent] matrix
         n = len(subs)  # n == B (Batchsize)
-        q_sub = torch.LongTensor(subs).cuda()  # [B]
-        q_rel = torch.LongTensor(rels).cuda()  # [B]
-        nodes = torch.cat([torch.arange(n).unsqueeze(1).cuda(), q_sub.unsqueeze(1)],
+        q_sub = torch.LongTensor(subs).to(self.device)  # [B]
+        q_rel = torch.LongTensor(rels).to(self.device)  # [B]
+        nodes = torch.cat([torch.arange(n, device=self.device).unsqueeze(1), q_sub.unsqueeze(1)],
                           1)  # [B, 2] with (batch_idx, node_idx)
         hidden = self.pre_embed[q_sub]  # [B, dim]
         hidden = self.dropout(hidden)#++++++++++++++++++++++++++++++++
         h0 = hidden.unsqueeze(0)  # [1, B, dim]
 
         self.edges_per_layer = {batch_idx: [] for batch_idx in range(n)}
+        self.n_edges = 0  # edges expanded over all layers, read by the memory model of AdaptiveBatcher on cpu
         for i in range(self.n_layer):
             # layers with sampling
             # nodes (of i-th layer): [k1, 2]
             # edges (of i-th layer): [k2, 6]
             # old_nodes_new_idx (of previous layer): [k1']
-            nodes, edges, old_nodes_new_idx = self.loader.get_neighbors(nodes.data.cpu().numpy(), n,
-                                                                        mode=mode)
+            if self.device_neighbors is not None:
+                nodes, edges, old_nodes_new_idx = self.device_neighbors.get_neighbors(nodes, n, mode=mode)
+            else:
+                nodes, edges, old_nodes_new_idx = self.loader.get_neighbors(nodes.data.cpu().numpy(), n,
+                                                                            mode=mode)
             n_node = nodes.size(0)
+            self.n_edges += len(edges)
             # old_nodes = nodes
 
             # GNN forward -> get hidden representation at i-th layer
@@ -220,7 +338,7 @@ class GNNModel(torch.nn.Module):
             hidden, nodes, sampled_nodes_idx = self.gnn_layers[i](q_sub, q_rel, hidden, edges, nodes, old_nodes_new_idx,n)
 
             # combine h0 and hi -> update hi with gate operation
-            h0 = torch.zeros(1, n_node, hidden.size(1)).cuda().index_copy_(1, old_nodes_new_idx,
+            h0 = torch.zeros(1, n_node, hidden.size(1), dtype=h0.dtype, device=self.device).index_copy_(1, old_nodes_new_idx,
                                                                            h0)
             h0 = h0[0, sampled_nodes_idx, :].unsqueeze(0)
             hidden = self.dropout(hidden)
@@ -245,15 +363,20 @@ class GNNModel(torch.nn.Module):
         scores = self.W_final(hidden).squeeze(-1)
 
         scores = self.lamda * scores + (1 - self.lamda) * selected_scores_tensor
+        scores = scores.float()  # the loss and ranking always see fp32 scores
 
         # non-visited entities.txt have 0 scores
-        scores_all = torch.zeros((n, self.loader.n_ent)).cuda()
-        # [B, n_all_nodes]
-        scores_all[[nodes[:, 0], nodes[:, 1]]] = scores
+        if sparse:
+            scores_all = SparseScores(nodes[:, 0], nodes[:, 1], scores, n, self.loader.n_ent)
+        else:
+            scores_all = torch.zeros((n, self.loader.n_ent), device=self.device)
+            # [B, n_all_nodes]
+            scores_all[[nodes[:, 0], nodes[:, 1]]] = scores
 
         lo = 0
         if  mode == 'train' and self.lossflag:
-            lo = self.regularizer((self.rela_embed.lhs.weight, self.rela_embed.rel.weight,self.rela_embed.rhs.weight))
+            with torch.autocast(self.device.type, enabled=False):
+                lo = self.regularizer((self.rela_embed.lhs.weight, self.rela_embed.rel.weight,self.rela_embed.rhs.weight))
 
         if mode == 'train':
             return scores_all, lo
@@ -7,32 +7,56 @@ import os
 class Refinement(torch.nn.Module):
     def __init__(
             self,sizes: Tuple[int, int], edim: int, rdim: int, gatecell: str,
-            init_size: float = 1e-3,
+            init_size: float = 1e-3, cache_budget: int = 2 ** 28,
     ):
         super(Refinement, self).__init__()
         self.sizes = sizes
         self.edim = edim
         self.rdim = rdim
         self.gatecell = gatecell
-        self.lhs = torch.nn.Embedding( sizes[0], edim).cuda()
-        self.rel = torch.nn.Embedding(sizes[1], rdim).cuda()
-        self.rhs = torch.nn.Embedding( sizes[0], edim).cuda()
+        self.lhs = torch.nn.Embedding( sizes[0], edim)
+        self.rel = torch.nn.Embedding(sizes[1], rdim)
+        self.rhs = torch.nn.Embedding( sizes[0], edim)
 
 
         self.gate = {
             'RNNCell': lambda: torch.nn.RNNCell(rdim, edim),
             'LSTMCell': lambda: torch.nn.LSTMCell(rdim, edim),
             'GRUCell': lambda: torch.nn.GRUCell(rdim, edim)
-        }[gatecell]().cuda()
+        }[gatecell]()
 
         self.lhs.weight.data *= init_size
         self.rel.weight.data *= init_size
         self.rhs.weight.data *= init_size
 
+        # eval-mode cache of refined embeddings: a [n_ent * n_rel, edim] table indexed by the
+        # (entity * n_rel + relation) key and the mask of its filled rows, no cache when the table
+        # would take more than cache_budget bytes
+        self.cache_budget = cache_budget
+        self.cache_values = None
+        self.cache_filled = None
+        self.cache_version = None
+
+    def train(self, mode=True):
+        self.cache_values = self.cache_filled = self.cache_version = None
+        return super(Refinement, self).train(mode)
 
     def forward(self, lhs_idx,rel_idx):#x.shape:batch_size*3
-        lhs = self.lhs(lhs_idx)
-        rel = self.rel(rel_idx)
+        rows, inverse = self.pairs(lhs_idx, rel_idx)
+        return rows[inverse]
+
+    def pairs(self, lhs_idx, rel_idx):
+        # the gate runs once per distinct (entity, relation) pair of the call, e.g. edges sharing head and
+        # relation or the self-loops
+        # returns the refined rows of the distinct pairs and the index of each input pair among them
+        keys, inverse = torch.unique(lhs_idx * self.sizes[1] + rel_idx, return_inverse=True)
+        if not self.training and not torch.is_grad_enabled():
+            return self.cached(keys), inverse
+        return self.refine(keys), inverse
+
+    def refine(self, keys):
+        lhs = self.lhs(keys // self.sizes[1])
+        rel = self.rel(keys % self.sizes[1])
 
         if self.gatecell == 'LSTMCell':
             c = torch.zeros_like(lhs)
@@ -41,6 +65,30 @@ class Refinement(torch.nn.Module):
             rel_update = self.gate(rel, lhs)
         return rel_update
 
+    def cached(self, keys):
+        # keys: sorted distinct keys; the cache persists across batches until any weight is updated or reloaded
+        n_keys = self.sizes[0] * self.sizes[1]
+        if n_keys * self.edim * self.lhs.weight.element_size() > self.cache_budget:
+            return self.refine(keys)
+        version = tuple((p.data_ptr(), p._version) for p in self.parameters())
+        if self.cache_version != version:
+            self.cache_values = self.cache_filled = None
+            self.cache_version = version
+
+        # only the rows of missing keys are computed and written
+        miss = keys if self.cache_filled is None else keys[~self.cache_filled[keys]]
+        if len(miss) > 0:
+            rows = self.refine(miss)
+            if self.cache_values is None or self.cache_values.dtype != rows.dtype:
+                if self.cache_values is not None:
+                    # autocast switched dtype, the cache starts over
+                    miss, rows = keys, self.refine(keys)
+                self.cache_values = rows.new_empty((n_keys, rows.shape[1]))
+                self.cache_filled = torch.zeros(n_keys, dtype=torch.bool, device=keys.device)
+            self.cache_values[miss] = rows
+            self.cache_filled[miss] = True
+        return self.cache_values[keys]
+
 class N3(torch.nn.Module):
     def __init__(self, weight: float):
         super(N3, self).__init__()
@@ -0,0 +1,244 @@
+# -*- coding:utf-8 -*-
+import asyncio
+import json
+import random
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+import torch
+
+from train import build, parser
+from utils import setup_device
+
+
+''' top-k link prediction service of BioGraphFusion: in-process, or over a local HTTP endpoint '''
+parser.add_argument('--host', type=str, default='127.0.0.1')
+parser.add_argument('--port', type=int, default=8080)
+parser.add_argument('--max_batch', type=int, default=32, help='Requests coalesced into one forward pass')
+parser.add_argument('--max_delay', type=float, default=10, help='Milliseconds the oldest request may wait for its batch to fill')
+
+
+class LinkPredictor(object):
+    # top-k tails of (head, relation) queries given by name, from a GNNModel and the name maps of its loader
+    # relations are the names of relation2id, or 'inv_' + name for the inverse direction
+    def __init__(self, model, loader):
+        self.model = model
+        self.loader = loader
+        self.relation2id = dict(loader.relation2id)
+        self.relation2id.update({'inv_' + name: r + loader.n_rel for name, r in loader.relation2id.items()})
+
+    def query(self, head, relation, k=10, filter_known=True):
+        # (sub, rel, k, filter_known) ids of a request, KeyError naming an unknown entity or relation,
+        # ValueError for values of the wrong type
+        if not isinstance(head, str) or not isinstance(relation, str):
+            raise ValueError('head and relation must be names')
+        if head not in self.loader.entity2id:
+            raise KeyError('unknown entity: %s' % head)
+        if relation not in self.relation2id:
+            raise KeyError('unknown relation: %s' % relation)
+        if isinstance(k, bool) or not isinstance(k, (int, str)):
+            raise ValueError('k must be a positive integer')
+        k = int(k)
+        if k <= 0:
+            raise ValueError('k must be positive')
+        return self.loader.entity2id[head], self.relation2id[relation], k, bool(filter_known)
+
+    def predict_batch(self, queries):
+        # queries: list of (sub, rel, k, filter_known) from query(), scored in one forward pass
+        # returns one list of (entity name, score) per query, best first
+        subs = np.array([q[0] for q in queries])
+        rels = np.array([q[1] for q in queries])
+        # known tails of the query in any split, dropped from its answers with filter_known
+        known = [self.loader.filters[(sub, rel)] if filter_known else np.zeros(0, dtype=np.int64)
+                 for sub, rel, _, filter_known in queries]
+        self.model.eval()
+        with torch.no_grad():
+            scores = self.model(subs, rels, mode='test', sparse=True)
+        topk_ent, topk_score = scores.topk(max(q[2] + len(f) for q, f in zip(queries, known)))
+        results = []
+        for i, (_, _, k, _) in enumerate(queries):
+            keep = ~np.isin(topk_ent[i], known[i])
+            results.append([(self.loader.id2entity[e], float(s))
+                            for e, s in zip(topk_ent[i][keep][:k], topk_score[i][keep][:k])])
+        return results
+
+    def predict(self, head, relation, k=10, filter_known=True):
+        return self.predict_batch([self.query(head, relation, k, filter_known)])[0]
+
+
+class MicroBatcher(object):
+    # coalesces concurrent requests into batched forward passes: a batch runs once it holds max_batch requests
+    # or its oldest request has waited max_delay seconds. forwards run one at a time in a worker thread,
+    # the event loop keeps queueing requests meanwhile
+    def __init__(self, predictor, max_batch=32, max_delay=0.01):
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+        self.task = None
+        self.served = 0
+        self.batches = 0
+        self.latencies = deque(maxlen=100000)
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def predict(self, head, relation, k=10, filter_known=True):
+        query = self.predictor.query(head, relation, k, filter_known)
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((query, future, time.time()))
+        return await future
+
+    async def next_batch(self):
+        batch = [await self.queue.get()]
+        deadline = batch[0][2] + self.max_delay
+        while len(batch) < self.max_batch:
+            if self.queue.empty():
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            else:
+                batch.append(self.queue.get_nowait())
+        return batch
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self.next_batch()
+            try:
+                results = await loop.run_in_executor(self.executor, self.predictor.predict_batch,
+                                                     [query for query, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            now = time.time()
+            for (_, future, t), result in zip(batch, results):
+                # clients that went away have cancelled their future
+                if not future.done():
+                    future.set_result(result)
+                self.latencies.append(now - t)
+            self.served += len(batch)
+            self.batches += 1
+
+    def stats(self):
+        latencies = np.array(self.latencies) * 1000
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) if len(latencies) else (0., 0., 0.)
+        return {'served': self.served, 'batches': self.batches, 'mean_batch': self.served / max(self.batches, 1),
+                'latency_ms': {'p50': p50, 'p90': p90, 'p99': p99}}
+
+
+class PredictionServer(object):
+    # minimal HTTP/1.1 endpoint with keep-alive on asyncio streams:
+    #   POST /predict  {"head", "relation", "k": 10, "filter_known": true} -> {"predictions": [{"entity", "score"}]}
+    #   GET  /stats    batching and latency statistics
+    #   GET  /sample?n=100  (head, relation) names of test queries, e.g. for load tests
+    reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}
+
+    def __init__(self, batcher):
+        self.batcher = batcher
+        self.test_q = batcher.predictor.loader.test_q
+
+    async def serve(self, host, port):
+        self.batcher.start()
+        server = await asyncio.start_server(self.handle, host, port)
+        print('==> serving on http://%s:%d' % (host, port))
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line.strip():
+                    break
+                headers = {}
+                try:
+                    method, target = request_line.decode('latin-1').split()[:2]
+                    while True:
+                        line = await reader.readline()
+                        if line in (b'\r\n', b'\n', b''):
+                            break
+                        name, _, value = line.decode('latin-1').partition(':')
+                        headers[name.strip().lower()] = value.strip()
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError('negative content-length')
+                except ValueError as e:
+                    # malformed request line or content-length, the rest of the stream cannot be framed
+                    await self.respond(writer, 400, {'error': 'malformed request: %s' % e})
+                    break
+                body = await reader.readexactly(length)
+                await self.respond(writer, *await self.route(method, target, body))
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, payload):
+        data = json.dumps(payload).encode()
+        writer.write(b'HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n\r\n'
+                     % (status, self.reasons[status].encode(), len(data)) + data)
+        await writer.drain()
+
+    async def route(self, method, target, body):
+        url = urlsplit(target)
+        try:
+            if method == 'POST' and url.path == '/predict':
+                try:
+                    request = json.loads(body)
+                    head, relation = request['head'], request['relation']
+                    k, filter_known = request.get('k', 10), request.get('filter_known', True)
+                except (ValueError, KeyError, TypeError) as e:
+                    return 400, {'error': 'expected a JSON object with head and relation: %r' % e}
+                predictions = await self.batcher.predict(head, relation, k, filter_known)
+                return 200, {'head': head, 'relation': relation,
+                             'predictions': [{'entity': e, 'score': s} for e, s in predictions]}
+            if method == 'GET' and url.path == '/stats':
+                return 200, self.batcher.stats()
+            if method == 'GET' and url.path == '/sample':
+                n = int(parse_qs(url.query).get('n', ['100'])[0])
+                loader = self.batcher.predictor.loader
+                rows = np.random.randint(0, len(self.test_q), n)
+                return 200, [[loader.id2entity[h], self.relation_name(r)] for h, r in self.test_q[rows]]
+            return 404, {'error': 'no route %s %s' % (method, url.path)}
+        except KeyError as e:
+            # unknown entity or relation
+            return 404, {'error': e.args[0]}
+        except ValueError as e:
+            return 400, {'error': str(e)}
+        except Exception as e:
+            return 500, {'error': repr(e)}
+
+    def relation_name(self, rel):
+        loader = self.batcher.predictor.loader
+        return loader.id2relation[rel] if rel < loader.n_rel else 'inv_' + loader.id2relation[rel - loader.n_rel]
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    random.seed(args.seed)
+    np.random.seed(args.seed)
+    torch.manual_seed(args.seed)
+    args.device = str(setup_device(args))
+    _, loader, model = build(args)
+    if args.weight is not None:
+        model.loadModel(args.weight)
+        model.model.updateTopkNums(args.n_node_topk)
+    else:
+        print('==> no --weight given, serving an untrained model')
+    predictor = LinkPredictor(model.model, loader)
+    batcher = MicroBatcher(predictor, max_batch=args.max_batch, max_delay=args.max_delay / 1000)
+    asyncio.run(PredictionServer(batcher).serve(args.host, args.port))
@@ -0,0 +1,68 @@
+# -*- coding:utf-8 -*-
+import multiprocessing
+import random
+import socket
+
+import numpy as np
+import pytest
+import torch
+
+N_QUERY = 20
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def train_steps(rank, world_size, edge_budget, port, queue):
+    # one rank: the first N_QUERY training queries of umls with plain SGD, small steps so that float noise
+    # in one step is not amplified by the next; no dropout and no gumbel noise, so every run is deterministic
+    from train import build, parser
+    from utils import init_distributed, setup_device
+    opts = parser.parse_args(['--data_path', 'data/umls', '--layers', '2', '--topk', '20', '--tau', '0',
+                              '--device', 'cpu', '--threads', '1', '--no_cache', '--prefetch', '0',
+                              '--world_size', str(world_size), '--dist_port', str(port),
+                              '--edge_budget', str(edge_budget)])
+    random.seed(opts.seed)
+    np.random.seed(opts.seed)
+    torch.manual_seed(opts.seed)
+    if world_size > 1:
+        init_distributed(rank, opts)
+    else:
+        setup_device(opts)
+    _, loader, model = build(opts)
+    model.model.dropout.p = 0
+    model.optimizer = torch.optim.SGD(model.model.parameters(), lr=1e-2)
+    loader.train_data = loader.train_data[:N_QUERY]
+    loader.n_train = N_QUERY
+    before = {k: v.detach().clone() for k, v in model.model.state_dict().items()}
+    loss = model.train_batch()
+    if rank == 0:
+        queue.put((loss, {k: (v - before[k]).numpy() for k, v in model.model.state_dict().items()}))
+
+
+def run(world_size, edge_budget):
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue()
+    port = free_port()
+    procs = [ctx.Process(target=train_steps, args=(rank, world_size, edge_budget, port, queue))
+             for rank in range(world_size)]
+    for p in procs:
+        p.start()
+    result = queue.get(timeout=600)
+    for p in procs:
+        p.join()
+    return result
+
+
+@pytest.mark.parametrize('edge_budget', [0, 20000])
+def test_data_parallel_steps_match_single_process(edge_budget):
+    # the same steps on 2 ranks: equal epoch loss and parameter updates
+    loss, updates = run(1, edge_budget)
+    loss_ddp, updates_ddp = run(2, edge_budget)
+    assert np.isclose(loss, loss_ddp, rtol=1e-5)
+    assert any(np.abs(u).max() > 0 for u in updates.values())
+    for name, update in updates.items():
+        assert np.allclose(update, updates_ddp[name], rtol=1e-4, atol=1e-6), name
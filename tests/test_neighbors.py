@@ -0,0 +1,60 @@
+# -*- coding:utf-8 -*-
+import types
+
+import numpy as np
+import pytest
+import torch
+from scipy.sparse import csr_matrix
+
+from kg_index import DeviceNeighbors, build_head_index, gather_neighbors, reindex_edges
+
+
+def random_graph(n_ent=50, n_rel=4, n_fact=400, seed=0):
+    # facts sorted by head with their offsets, some entities without facts
+    rng = np.random.RandomState(seed)
+    KG = np.stack([rng.randint(0, n_ent - 5, n_fact), rng.randint(0, 2 * n_rel + 1, n_fact),
+                   rng.randint(0, n_ent, n_fact)], 1).astype(np.int32)
+    return build_head_index(KG, n_ent)
+
+
+def random_frontier(n_ent, batchsize=4, size=30, seed=0):
+    # [N, 2] distinct (batch_idx, node_idx) sorted like the nodes of a layer
+    rng = np.random.RandomState(seed)
+    nodes = np.stack([rng.randint(0, batchsize, size), rng.randint(0, n_ent, size)], 1)
+    return np.unique(nodes, axis=0)
+
+
+def spmm_neighbors(KG, n_ent, nodes):
+    # reference: the one-hot sparse matmul used before the CSR index, one column per query
+    M_sub = csr_matrix((np.ones(len(KG)), (np.arange(len(KG)), KG[:, 0])), shape=(len(KG), n_ent))
+    node_1hot = csr_matrix((np.ones(len(nodes)), (nodes[:, 1], nodes[:, 0])), shape=(n_ent, len(nodes)))
+    edges = np.nonzero(M_sub.dot(node_1hot))
+    return np.concatenate([np.expand_dims(edges[1], 1), KG[edges[0]]], axis=1)
+
+
+def sort_rows(a):
+    return a[np.lexsort(a.T[::-1])]
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_gather_neighbors_matches_spmm(seed):
+    KG, offsets = random_graph(seed=seed)
+    nodes = random_frontier(len(offsets) - 1, seed=seed)
+    out = gather_neighbors(KG, offsets, nodes)
+    assert out.dtype == np.int64
+    assert np.array_equal(sort_rows(out), sort_rows(spmm_neighbors(KG, len(offsets) - 1, nodes)))
+
+
+@pytest.mark.parametrize('mode', ['train', 'test'])
+def test_device_neighbors_match_loader_neighbors(mode):
+    n_rel = 4
+    KG, offsets = random_graph(n_rel=n_rel, seed=1)
+    tKG, tKG_offsets = random_graph(n_rel=n_rel, n_fact=600, seed=2)
+    loader = types.SimpleNamespace(KG=KG, KG_offsets=offsets, tKG=tKG, tKG_offsets=tKG_offsets, n_rel=n_rel)
+    nodes = random_frontier(len(offsets) - 1, seed=3)
+
+    graph = (KG, offsets) if mode == 'train' else (tKG, tKG_offsets)
+    ref = reindex_edges(torch.LongTensor(gather_neighbors(*graph, nodes)), n_rel)
+    out = DeviceNeighbors(loader).get_neighbors(torch.as_tensor(nodes), len(nodes), mode=mode)
+    for a, b in zip(ref, out):
+        assert torch.equal(a, b)
@@ -0,0 +1,53 @@
+# -*- coding:utf-8 -*-
+import numpy as np
+import pytest
+
+from utils import cal_performance, rank_metrics
+
+
+def loop_performance(ranks, num):
+    # reference: the per-query loop cal_performance used before rank_metrics
+    mrr = (1. / ranks).sum() / len(ranks)
+    hits = [sum(ranks <= k) * 1.0 / len(ranks) for k in (1, 3, 10, 50)]
+
+    def calculate_ap(rankings, K):
+        unique_rankings = np.sort(np.unique(rankings))
+        ap_sum, num_hits = 0.0, 0
+        for i, rank in enumerate(unique_rankings):
+            if rank <= K:
+                num_hits += 1
+                ap_sum += num_hits / (i + 1)
+        return ap_sum / len(unique_rankings) if len(unique_rankings) > 0 else 0.0
+
+    def calculate_map(K):
+        start, ap_values = 0, []
+        for n in num:
+            ap_values.append(calculate_ap(ranks[start:start + n], K))
+            start += n
+        return sum(ap_values) / len(ap_values) if ap_values else 0.0
+
+    return (mrr, *hits, *[calculate_map(k) for k in (1, 3, 10, 50)])
+
+
+def random_ranks(n_query=200, seed=0):
+    # queries with no answer, one answer or many, repeated ranks within a query, ranks around every K
+    rng = np.random.RandomState(seed)
+    num = rng.choice([0, 1, 2, 5, 30], n_query)
+    ranks = rng.choice([1, 2, 3, 4, 9, 10, 11, 49, 50, 51, 400], num.sum())
+    return ranks, num
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_cal_performance_matches_loop(seed):
+    ranks, num = random_ranks(seed=seed)
+    assert cal_performance(ranks, num) == loop_performance(ranks, num)
+
+
+def test_rank_metrics_any_ks():
+    ranks, num = random_ranks(seed=3)
+    offsets = np.concatenate([[0], np.cumsum(num)])
+    mrr, hits, maps = rank_metrics(ranks, offsets, ks=(50, 3))
+    ref = loop_performance(ranks, num)
+    assert mrr == ref[0]
+    assert list(hits) == [ref[4], ref[2]]
+    assert list(maps) == [ref[8], ref[6]]
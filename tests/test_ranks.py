@@ -0,0 +1,46 @@
+# -*- coding:utf-8 -*-
+import numpy as np
+import pytest
+import torch
+
+from utils import cal_ranks, count_ranks
+
+
+def random_batch(n_query=8, n_ent=300, seed=0):
+    # coarse scores so that ties occur, one or more answers per query, and known answers that are not answers
+    rng = np.random.RandomState(seed)
+    scores = np.round(rng.randn(n_query, n_ent), 1).astype(np.float32)
+    filters = rng.rand(n_query, n_ent) < 0.05
+    labels = np.zeros_like(filters)
+    labels[np.arange(n_query), rng.randint(0, n_ent, n_query)] = True
+    labels |= filters & (rng.rand(n_query, n_ent) < 0.5)
+    filters |= labels
+    return scores, labels, filters
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('on_device', [False, True])
+def test_count_ranks_matches_rankdata(seed, on_device):
+    scores, labels, filters = random_batch(seed=seed)
+    objs, filter_idx = np.nonzero(labels), np.nonzero(filters)
+    ref = cal_ranks(scores, objs, filters)
+    assert list(cal_ranks(scores, labels, filters)) == list(ref)
+    out = count_ranks(torch.from_numpy(scores) if on_device else scores, objs, filter_idx)
+    assert out.dtype == np.int64
+    assert list(out) == list(ref)
+    # a dense boolean mask of known answers gives the same ranks
+    assert list(count_ranks(scores, objs, filters)) == list(ref)
+
+
+def test_count_ranks_in_chunks():
+    # chunks smaller than a row still give the ranks of one pass
+    scores, labels, filters = random_batch(seed=4)
+    objs, filter_idx = np.nonzero(labels), np.nonzero(filters)
+    assert list(count_ranks(scores, objs, filter_idx, chunk=1)) == list(count_ranks(scores, objs, filter_idx))
+
+
+def test_count_ranks_without_answers():
+    scores, _, filters = random_batch()
+    empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    assert len(count_ranks(scores, empty, np.nonzero(filters))) == 0
+    assert len(count_ranks(torch.from_numpy(scores), empty, np.nonzero(filters))) == 0
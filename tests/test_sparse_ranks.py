@@ -0,0 +1,58 @@
+# -*- coding:utf-8 -*-
+import numpy as np
+import pytest
+import torch
+
+from models import SparseScores
+from utils import cal_ranks_sparse, count_ranks
+
+
+def random_scores(n_query=5, n_ent=30, n_visited=40, seed=0):
+    # distinct visited (row, col) pairs in random order, float32 scores
+    rng = np.random.default_rng(seed)
+    keys = rng.permutation(rng.choice(n_query * n_ent, n_visited, replace=False))
+    rows, cols = keys // n_ent, keys % n_ent
+    return rows, cols, rng.standard_normal(len(keys)).astype(np.float32), n_query, n_ent
+
+
+def answers(n_query, n_ent, seed=0):
+    # (rows, cols) of two answers per query, and of the known answers: the answers and two more per query
+    rng = np.random.default_rng(seed + 1)
+    picks = np.stack([rng.choice(n_ent, 4, replace=False) for _ in range(n_query)])
+    rows = np.repeat(np.arange(n_query), 2)
+    labels = rows, np.sort(picks[:, :2], 1).ravel()
+    filters = np.repeat(np.arange(n_query), 4), np.sort(picks, 1).ravel()
+    return labels, filters
+
+
+def dense(rows, cols, values, n_query, n_ent, default):
+    scores = np.full((n_query, n_ent), default, dtype=values.dtype)
+    scores[rows, cols] = values
+    return scores
+
+
+@pytest.mark.parametrize('default', [0., -1., 1.5])
+@pytest.mark.parametrize('n_visited', [0, 1, 40, 150])
+def test_cal_ranks_sparse_matches_dense_ranks(default, n_visited):
+    # n_visited 0: an empty frontier, every answer ranks against the default score alone
+    rows, cols, values, n_query, n_ent = random_scores(n_visited=n_visited)
+    labels, filters = answers(n_query, n_ent)
+    ranks = cal_ranks_sparse((rows, cols, values), labels, filters, n_query, n_ent, default=default)
+    ref = count_ranks(dense(rows, cols, values, n_query, n_ent, default), labels, filters)
+    assert list(ranks) == list(ref)
+
+
+@pytest.mark.parametrize('default', [0., -1., 1.5])
+@pytest.mark.parametrize('n_visited', [0, 1, 40, 150])
+def test_topk_matches_dense_topk(default, n_visited):
+    # without ties, the top k of the dense scores
+    rows, cols, values, n_query, n_ent = random_scores(n_visited=n_visited, seed=2)
+    scores = SparseScores(torch.as_tensor(rows), torch.as_tensor(cols), torch.as_tensor(values), n_query, n_ent,
+                          default=default)
+    ref = dense(rows, cols, values, n_query, n_ent, default)
+    for k in (1, 7, n_ent):
+        topk_ent, topk_score = scores.topk(k)
+        # unvisited entities at the default score come by increasing id
+        order = np.argsort(-ref, axis=1, kind='stable')[:, :k]
+        assert np.array_equal(topk_ent, order)
+        assert np.array_equal(topk_score, np.take_along_axis(ref, order, 1))
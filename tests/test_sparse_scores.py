@@ -0,0 +1,64 @@
+# -*- coding:utf-8 -*-
+import pytest
+import torch
+
+from base_model import TrainLoss
+from models import SparseScores
+
+
+def dense_loss(scores, objs):
+    # the dense training loss of TrainLoss; [B] broadcast against [B, 1] sums the batch loss B times
+    pos_scores = scores[torch.arange(len(scores)), objs]
+    max_n = torch.max(scores, 1, keepdim=True)[0]
+    return torch.sum(- pos_scores + max_n + torch.log(torch.sum(torch.exp(scores - max_n), 1)))
+
+
+def make_scores(n_ent=12, seed=0):
+    # query 0 partly visited with its target visited, query 1 fully visited,
+    # query 2 partly visited with its target never visited, query 3 visits nothing but one node
+    g = torch.Generator().manual_seed(seed)
+    rows = [torch.zeros(5, dtype=torch.long), torch.ones(n_ent, dtype=torch.long),
+            torch.full((4,), 2, dtype=torch.long), torch.full((1,), 3, dtype=torch.long)]
+    cols = [torch.tensor([0, 2, 3, 7, 9]), torch.arange(n_ent), torch.tensor([1, 4, 5, 6]), torch.tensor([11])]
+    batch_idx, entity_idx = torch.cat(rows), torch.cat(cols)
+    score = (3 * torch.randn(len(batch_idx), generator=g, dtype=torch.float64)).requires_grad_()
+    objs = torch.tensor([3, 8, 10, 0])
+    return batch_idx, entity_idx, score, n_ent, objs
+
+
+@pytest.mark.parametrize('default', [0., -2.5, 4.])
+def test_cross_entropy_matches_dense_loss(default):
+    batch_idx, entity_idx, score, n_ent, objs = make_scores()
+    sparse = SparseScores(batch_idx, entity_idx, score, len(objs), n_ent, default=default)
+    loss = len(objs) * sparse.cross_entropy(objs)
+    grad, = torch.autograd.grad(loss, score)
+
+    ref = dense_loss(sparse.to_dense(), objs)
+    ref_grad, = torch.autograd.grad(ref, score)
+    assert torch.allclose(loss, ref, rtol=1e-12, atol=1e-12)
+    assert torch.allclose(grad, ref_grad, rtol=1e-12, atol=1e-12)
+
+
+class FixedScores(torch.nn.Module):
+    # stands in for GNNModel, returning the given scores dense or sparse
+    def __init__(self, batch_idx, entity_idx, score, n_ent):
+        super(FixedScores, self).__init__()
+        self.batch_idx, self.entity_idx, self.n_ent = batch_idx, entity_idx, n_ent
+        self.score = torch.nn.Parameter(score.detach().clone())
+
+    def forward(self, subs, rels, sparse=False):
+        scores = SparseScores(self.batch_idx, self.entity_idx, self.score, len(subs), self.n_ent)
+        return (scores if sparse else scores.to_dense()), 0
+
+
+def test_train_loss_sparse_branch_matches_dense_branch():
+    batch_idx, entity_idx, score, n_ent, objs = make_scores(seed=1)
+    model = FixedScores(batch_idx, entity_idx, score, n_ent)
+    subs = rels = torch.zeros(len(objs), dtype=torch.long)
+    losses, grads = [], []
+    for sparse in (False, True):
+        loss, _ = TrainLoss(model, sparse, False, torch.bfloat16)(subs, rels, objs)
+        losses.append(loss)
+        grads.append(torch.autograd.grad(loss, model.score)[0])
+    assert torch.allclose(losses[0], losses[1], rtol=1e-12, atol=1e-12)
+    assert torch.allclose(grads[0], grads[1], rtol=1e-12, atol=1e-12)
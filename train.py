@@ -5,6 +5,8 @@ import os
 import argparse
 
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 import numpy as np
 from load_data import DataLoader_DisGeNet, DataLoader_STITCH, DataLoader_UMLS
 from base_model import BaseModel
@@ -21,6 +23,8 @@ parser.add_argument('--data_path', type=str, default='data/Disease-Gene/DisGeNet
 parser.add_argument('--seed', type=int, default=
 1234)
 parser.add_argument('--gpu', type=int, default=7)
+parser.add_argument('--device', type=str, default=None, help='Torch device, e.g. cpu or cuda:0; defaults to --gpu when cuda is available, else cpu')
+parser.add_argument('--threads', type=int, default=8, help='Intra-op threads on the cpu path')
 parser.add_argument('--topk', type=int, default=800)
 parser.add_argument('--layers', type=int, default=6)
 parser.add_argument('--sampling', type=str, default='incremental')
@@ -33,9 +37,25 @@ parser.add_argument('--HPO', action='store_true')
 parser.add_argument('--eval_with_node_usage', action='store_true')
 parser.add_argument('--scheduler', type=str, default='exp')
 parser.add_argument('--remove_1hop_edges', action='store_true')
+parser.add_argument('--no_cache', action='store_true', help='Parse the raw files instead of the binary dataset cache')
+parser.add_argument('--async_shuffle', action='store_true', help='Prepare the next fact/train split in a background thread')
+parser.add_argument('--device_neighbors', action='store_true', help='Expand neighbors with tensor ops on the model device')
+parser.add_argument('--prefetch', type=int, default=2, help='Number of batches prepared ahead, and of evaluated batches ranked behind, in background threads, 0 to disable')
+parser.add_argument('--prefetch_workers', type=int, default=1, help='Threads preparing prefetched batches and ranking evaluated ones')
+parser.add_argument('--sparse_scores', action='store_true', help='Score, rank and predict from the visited nodes instead of dense [batch, n_ent] matrices')
+parser.add_argument('--amp', action='store_true', help='Mixed precision training: fp16 with loss scaling on gpu, bf16 on cpu')
+parser.add_argument('--nan_policy', choices=['skip', 'rollback', 'repair'], default='skip', help='Handling of training steps with a non-finite loss or gradient')
+parser.add_argument('--snapshot_interval', type=int, default=100, help='Healthy steps between the snapshots restored by --nan_policy rollback')
+parser.add_argument('--world_size', type=int, default=1, help='Data parallel training processes on this machine (gloo on cpu, nccl with one gpu per process from --gpu)')
+parser.add_argument('--dist_port', type=int, default=29500, help='Local port of the process group rendezvous')
+parser.add_argument('--edge_budget', type=int, default=0, help='Estimated edges per training micro-batch; micro-batches fill the budget and accumulate gradients into steps of at least n_batch queries (0 disables)')
 parser.add_argument('--fact_ratio', type=float, default=0.92)#0.9  剩下0.1用作真正的train
 parser.add_argument('--epoch', type=int, default=100)
 parser.add_argument('--eval_interval', type=int, default=1)
+parser.add_argument('--eval_budget', type=float, default=0, help='Memory budget in MB of a no_grad evaluation batch; batches are sized to it from estimated and measured costs instead of n_tbatch (0 disables)')
+parser.add_argument('--val_sample', type=int, default=0, help='Validation queries of the per-epoch sampled evaluation; the full valid/test pass only runs when its MRR interval lies above the best MRR (0 disables)')
+parser.add_argument('--val_confidence', type=float, default=0.95, help='Confidence level of the sampled validation intervals')
+parser.add_argument('--bootstrap', type=int, default=1000, help='Bootstrap resamples of the sampled validation')
 
 
 
@@ -51,37 +71,27 @@ parser.add_argument('--Flag', default=True, help='Whether to use N3 regularizer'
 parser.add_argument('--reg', default=0.1, type=float, help="Regularization weight")
 parser.add_argument('--logFlag', default=True, help='Whether to write log')
 parser.add_argument('--lamda', default=0.7, type=float, help="scores weight")
-args = parser.parse_args()
-
-if args.data_path == 'data/Disease-Gene/DisGeNet_cv':
-    args.BKG_list= ['disease-drug.txt', 'chemical-gene.txt']
-elif args.data_path == 'data/Protein-Chemical/STITCH':
-    args.BKG_list = ['disease-gene.txt', 'disease-drug.txt']
-
-
-
-if __name__ == '__main__':
-    opts = args
-    np.random.seed(args.seed)
-    torch.manual_seed(args.seed)
-    torch.set_num_threads(8)
-
-    dataset = args.data_path
+def build(opts):
+    # the loader of --data_path and a BaseModel with the hyperparameters of its dataset
+    if opts.data_path == 'data/Disease-Gene/DisGeNet_cv':
+        opts.BKG_list= ['disease-drug.txt', 'chemical-gene.txt']
+    elif opts.data_path == 'data/Protein-Chemical/STITCH':
+        opts.BKG_list = ['disease-gene.txt', 'disease-drug.txt']
+
+    dataset = opts.data_path
     dataset = dataset.split('/')
     if len(dataset[-1]) > 0:
         dataset = dataset[-1]
     else:
         dataset = dataset[-2]
 
-    torch.cuda.set_device(opts.gpu)
-    print('==> gpu:', opts.gpu)
     if dataset == 'DisGeNet_cv':
         opts.max_BKG_triples = 15000
         DataLoader = DataLoader_DisGeNet
     elif dataset =='STITCH':
         opts.max_BKG_triples = 10000
         DataLoader = DataLoader_STITCH
-    elif dataset == 'UMLS':
+    elif dataset.lower() == 'umls':
         DataLoader = DataLoader_UMLS
         
     loader = DataLoader(opts)
@@ -116,7 +126,7 @@ if __name__ == '__main__':
         opts.n_layer = opts.layers
         opts.n_batch = opts.n_tbatch = 10
 
-    elif dataset == 'umls':
+    elif dataset.lower() == 'umls':
         opts.lr = 0.0012
         opts.decay_rate = 0.998
         opts.lamb = 0.00014
@@ -129,8 +139,24 @@ if __name__ == '__main__':
         opts.n_layer = opts.layers
         opts.n_batch = opts.n_tbatch = 10
 
+    model = BaseModel(opts, loader)
+    return dataset, loader, model
+
 
+def main(rank, opts):
+    # every rank seeds alike, so all of them sample the same BKG triples and train splits
+    random.seed(opts.seed)
+    np.random.seed(opts.seed)
+    torch.manual_seed(opts.seed)
+    torch.set_num_threads(opts.threads)
 
+    if opts.world_size > 1:
+        opts.device = str(init_distributed(rank, opts))
+    else:
+        opts.device = str(setup_device(opts))
+    print('==> rank: %d device: %s' % (rank, opts.device))
+
+    dataset, loader, model = build(opts)
 
     # check all output paths
     checkPath('./results/')
@@ -138,7 +164,8 @@ if __name__ == '__main__':
     checkPath(f'{loader.task_dir}/saveModel/')
 
 
-    model = BaseModel(opts, loader)
+    # only rank 0 logs, evaluates and saves; the others wait for it in the next step
+    main_rank = rank == 0
 
 
     opts.perf_file = f'results/{dataset}/{model.modelName}.txt'
@@ -148,12 +175,12 @@ if __name__ == '__main__':
     opts.lr, opts.decay_rate, opts.lamb, opts.hidden_dim, opts.attn_dim, opts.n_layer, opts.n_batch, opts.dropout,
     opts.act, opts.topk, opts.rdim, opts.seed, opts.reg,opts.lamda,opts.fact_ratio)
     print(config_str)
-    if opts.logFlag:
+    if opts.logFlag and main_rank:
         with open(opts.perf_file, 'a+') as f:
             f.write(config_str)
 
-    if args.weight != None:
-        model.loadModel(args.weight)
+    if opts.weight != None:
+        model.loadModel(opts.weight)
         model._update()
         model.model.updateTopkNums(opts.n_node_topk)
         print(model.model.lamda)
@@ -161,10 +188,20 @@ if __name__ == '__main__':
     if opts.train:
         # training model
         best_v_mrr = 0
+        best_str = ''
         for epoch in range(opts.epoch):
             epoch_train_loss=model.train_batch()
             # eval on val/test set
-            if (epoch+1) % args.eval_interval == 0:
+            full_eval = (epoch+1) % opts.eval_interval == 0 and main_rank
+            if full_eval and opts.val_sample > 0:
+                # full evaluation only when the sampled estimate beats the best by more than its uncertainty
+                sample_dict, sample_str = model.evaluate_sample()
+                print(sample_str)
+                if opts.logFlag:
+                    with open(opts.perf_file, 'a+') as f:
+                        f.write(sample_str)
+                full_eval = sample_dict['v_mrr_low'] > best_v_mrr
+            if full_eval:
                 result_dict, out_str = model.evaluate(eval_val=True, eval_test=True)
                 v_mrr, t_mrr = result_dict['v_mrr'], result_dict['t_mrr']
                 print(out_str)
@@ -178,11 +215,23 @@ if __name__ == '__main__':
                     BestMetricStr = f'ValMRR_{str(v_mrr)[:5]}_TestMRR_{str(t_mrr)[:5]}'#模型文件名更改处2
                     model.saveModelToFiles(BestMetricStr, deleteLastFile=False)
         gc.collect()
-        torch.cuda.empty_cache()
-        print(best_str)
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        if main_rank:
+            print(best_str)
 
-    if opts.eval:
+    if opts.eval and main_rank:
         # evaluate on test set with loaded weight to save time
         result_dict, out_str = model.evaluate(eval_val=False, eval_test=True, verbose=True)
         print(result_dict, '\n', out_str)
 
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.world_size > 1:
+        mp.spawn(main, args=(args,), nprocs=args.world_size)
+    else:
+        main(0, args)
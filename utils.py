@@ -1,74 +1,457 @@
 # -*- coding:utf-8 -*-
 import numpy as np
+import torch
+import torch.distributed as dist
 from scipy.stats import rankdata
 import os
+import copy
+import datetime
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 def checkPath(path):
     if not os.path.exists(path):
         os.mkdir(path)
     return
 
+def get_device(args):
+    # --device if given, else the selected gpu when cuda is available, else cpu
+    device = getattr(args, 'device', None)
+    if device is None:
+        device = f'cuda:{getattr(args, "gpu", 0)}' if torch.cuda.is_available() else 'cpu'
+    return torch.device(device)
+
+def init_distributed(rank, args):
+    # one process of --world_size on this machine: gloo on cpu, nccl on gpu (one gpu per rank from --gpu)
+    if torch.cuda.is_available() and getattr(args, 'device', None) in (None, 'cuda'):
+        args.device = f'cuda:{getattr(args, "gpu", 0) + rank}'
+    else:
+        args.threads = max(1, (getattr(args, 'threads', None) or os.cpu_count()) // args.world_size)
+    device = setup_device(args)
+    # rank 0 evaluates between epochs while the others wait in the next all-reduce
+    dist.init_process_group('nccl' if device.type == 'cuda' else 'gloo',
+                            init_method=f'tcp://127.0.0.1:{args.dist_port}', rank=rank,
+                            world_size=args.world_size, timeout=datetime.timedelta(hours=3))
+    return device
+
+def setup_device(args):
+    device = get_device(args)
+    if device.type == 'cuda':
+        torch.cuda.set_device(device)
+    else:
+        # cpu path: size the intra-op pool and flush denormals, which are slow on x86
+        torch.set_num_threads(getattr(args, 'threads', None) or os.cpu_count())
+        torch.set_flush_denormal(True)
+    return device
+
+def finite_norms(tensors):
+    # one fused reduction: a non-finite entry anywhere makes the sum non-finite
+    if hasattr(torch, '_foreach_norm'):
+        return torch.stack(torch._foreach_norm(tensors)).sum()
+    return torch.stack([t.norm() for t in tensors]).sum()
+
+class NumericalHealth(object):
+    # non-finite guard of the training steps, one fused check of the loss and all gradients per step
+    # policy: 'skip' drops the step
+    #         'rollback' drops the step and restores the model and optimizer from the last snapshot,
+    #                    taken every `snapshot_interval` healthy steps
+    #         'repair' zeroes the gradient rows holding non-finite values and steps with the others
+    # with loss scaling (scaled=True) non-finite gradients under a finite loss are overflows of the scale, left to
+    # the GradScaler, which skips the step and lowers the scale; the policy applies to a non-finite loss, or to
+    # gradients still non-finite after max_overflows overflows in a row
+    def __init__(self, model, policy='skip', snapshot_interval=100, max_overflows=10):
+        assert policy in ('skip', 'rollback', 'repair')
+        self.model = model
+        self.policy = policy
+        self.snapshot_interval = snapshot_interval
+        self.max_overflows = max_overflows
+        self.snapshot = None
+        self.overflow_run = 0
+        self.counters = {'steps': 0, 'non_finite': 0, 'overflows': 0, 'skipped': 0, 'rollbacks': 0, 'repaired_rows': 0}
+
+    def grads(self):
+        return [p.grad for p in self.model.parameters() if p.grad is not None]
+
+    def check(self, loss, scaled=False):
+        # returns (healthy, loss value) with a single device sync
+        grads = self.grads()
+        norms = finite_norms(grads) if len(grads) > 0 else loss.new_zeros(())
+        grad_norm, loss_value = torch.stack([norms.float(), loss.detach().float()]).tolist()
+        self.counters['steps'] += 1
+        healthy = np.isfinite(grad_norm) and np.isfinite(loss_value)
+        if scaled and not healthy and np.isfinite(loss_value):
+            self.overflow_run += 1
+            if self.overflow_run < self.max_overflows:
+                self.counters['overflows'] += 1
+                return True, loss_value
+        elif healthy:
+            self.overflow_run = 0
+        if not healthy:
+            self.counters['non_finite'] += 1
+        return healthy, loss_value
+
+    def handle(self, optimizer):
+        # on a non-finite step, returns whether the optimizer should still step
+        if self.policy == 'repair':
+            for g in self.grads():
+                bad = ~torch.isfinite(g)
+                rows = bad.flatten(1).any(1) if g.dim() > 1 else bad
+                self.counters['repaired_rows'] += int(rows.sum())
+                g[rows] = 0
+            return True
+        if self.policy == 'rollback' and self.snapshot is not None:
+            self.model.load_state_dict(self.snapshot[0])
+            optimizer.load_state_dict(self.snapshot[1])
+            self.counters['rollbacks'] += 1
+        else:
+            self.counters['skipped'] += 1
+        optimizer.zero_grad()
+        return False
+
+    def stepped(self, optimizer):
+        # the rollback snapshot, the only whole-model copy, every snapshot_interval healthy steps
+        if self.policy == 'rollback' and (self.snapshot is None or self.counters['steps'] % self.snapshot_interval == 0):
+            self.snapshot = ({k: v.detach().clone() for k, v in self.model.state_dict().items()},
+                             copy.deepcopy(optimizer.state_dict()))
+
+    def summary(self):
+        return ' '.join('%s:%d' % (k, v) for k, v in self.counters.items())
+
+def pack_batches(costs, batch_size, budget, rank=0, world_size=1):
+    # splits the queries, in order, into optimizer steps of micro-batches (one forward each)
+    # budget <= 0: steps of batch_size queries, one micro-batch each
+    # budget > 0: a micro-batch takes consecutive queries while their summed cost fits budget, a query over
+    #   budget goes alone, so cheap queries are packed past batch_size and costly ones split; a step
+    #   accumulates micro-batches until it holds at least batch_size queries (the effective batch)
+    # with world_size > 1 the queries of a micro-batch are dealt round-robin over the ranks, the share of every
+    # rank within budget, and a last micro-batch too short to give every rank a query is left out
+    # costs: [N_query], returns a list of (step_size, list of index arrays of this rank)
+    n_query = len(costs)
+    if budget <= 0:
+        micro = [np.arange(start, min(start + batch_size, n_query)) for start in range(0, n_query, batch_size)]
+    else:
+        micro, start = [], 0
+        spent = np.zeros(world_size)
+        for i in range(n_query):
+            r = (i - start) % world_size
+            if i - start >= world_size and spent[r] + costs[i] > budget:
+                micro.append(np.arange(start, i))
+                start, r = i, 0
+                spent[:] = 0
+            spent[r] += costs[i]
+        micro.append(np.arange(start, n_query))
+    steps, step, step_size = [], [], 0
+    for idx in micro:
+        if len(idx) < world_size:
+            break
+        step.append(idx[rank::world_size])
+        step_size += len(idx)
+        if step_size >= batch_size:
+            steps.append((step_size, step))
+            step, step_size = [], 0
+    if len(step) > 0:
+        steps.append((step_size, step))
+    return steps
+
+class BatchPrefetcher(object):
+    # prepares the next `depth` batches in background threads while the consumer works on the current one
+    # make_batch: function of a batch index, run in a worker thread
+    # wait_time: seconds the consumer spent blocked on batches that were not ready yet
+    # total: number of batches, None when indices is a generator, e.g. of AdaptiveBatcher.batches
+    def __init__(self, make_batch, indices, depth=2, workers=1):
+        self.make_batch = make_batch
+        self.indices = indices
+        self.total = len(indices) if hasattr(indices, '__len__') else None
+        self.depth = depth
+        self.workers = workers
+        self.wait_time = 0.
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for i in self.indices:
+                yield self.make_batch(i)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # bounded queue of batches in flight, consumed in submission order
+            pending = deque()
+            for i in self.indices:
+                pending.append(executor.submit(self.make_batch, i))
+                if len(pending) > self.depth:
+                    yield self.next_batch(pending)
+            while pending:
+                yield self.next_batch(pending)
+
+    def next_batch(self, pending):
+        t = time.time()
+        batch = pending.popleft().result()
+        self.wait_time += time.time() - t
+        return batch
+
+
+def is_out_of_memory(error):
+    # cuda out of memory errors, and failed cpu allocations
+    return isinstance(error, MemoryError) or (isinstance(error, RuntimeError) and (
+        'out of memory' in str(error) or "can't allocate memory" in str(error)))
+
+class AdaptiveBatcher(object):
+    # batches of consecutive queries sized to a memory budget (bytes)
+    # costs: [N_query] estimated bytes of every query; a batch takes queries while scale times their summed cost
+    # fits the budget. scale follows the largest measured peak / estimate of the finished batches, so batches
+    # grow while the estimate leaves headroom; after running out of memory, batches are kept to half the failed one
+    # the peak is the allocator's on cuda, and on cpu the bytes modelled from the edges a batch actually expanded
+    def __init__(self, costs, budget):
+        self.costs = costs
+        self.budget = budget
+        self.scale = 1.
+        self.measured = False
+        self.backoffs = 0
+
+    def batches(self, indices):
+        # yields index arrays of indices, each sized with the scale of the moment it is drawn
+        cumulative = np.cumsum(self.costs[indices])
+        start = 0
+        while start < len(indices):
+            spent = cumulative[start - 1] if start > 0 else 0
+            end = max(start + 1, np.searchsorted(cumulative, spent + self.budget / self.scale, side='right'))
+            yield indices[start:end]
+            start = end
+
+    def observe(self, batch_idx, peak):
+        # peak: bytes a batch allocated on top of what was allocated before it
+        ratio = peak / max(self.costs[batch_idx].sum(), 1)
+        # the first measurement replaces the initial guess, not the scale of an earlier backoff
+        self.scale = ratio if not self.measured and not self.backoffs else max(self.scale, ratio)
+        self.measured = True
+
+    def backoff(self, batch_idx):
+        # batches drawn before the failure may fail too, they do not shrink the batches further
+        self.scale = max(self.scale, 2 * self.budget / max(self.costs[batch_idx].sum(), 1))
+        self.backoffs += 1
+
+
+class RankPipeline(object):
+    # ranks the outputs of batch i in background threads while the caller computes batch i + 1,
+    # with at most `depth` batches in flight; ranks are collected in submission order
+    # rank_fn: function of one batch's outputs returning its ranks, run in a worker thread
+    # rank_time: seconds spent in rank_fn, wait_time: seconds the caller blocked on ranks not ready yet
+    def __init__(self, rank_fn, depth=2, workers=1):
+        self.rank_fn = rank_fn
+        self.depth = depth
+        self.workers = workers
+        self.rank_time = 0.
+        self.wait_time = 0.
+        self.ranks = []
+        self.pending = deque()
+        self.executor = None
+
+    def __enter__(self):
+        if self.depth > 0:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers)
+        return self
+
+    def __exit__(self, *exc):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def timed_rank(self, *outputs):
+        t = time.time()
+        ranks = self.rank_fn(*outputs)
+        return ranks, time.time() - t
+
+    def submit(self, *outputs):
+        if self.executor is None:
+            self.collect(self.timed_rank(*outputs))
+            return
+        self.pending.append(self.executor.submit(self.timed_rank, *outputs))
+        if len(self.pending) > self.depth:
+            self.next_ranks()
+
+    def next_ranks(self):
+        t = time.time()
+        result = self.pending.popleft().result()
+        self.wait_time += time.time() - t
+        self.collect(result)
+
+    def collect(self, result):
+        ranks, rank_time = result
+        self.ranks += list(ranks)
+        self.rank_time += rank_time
+
+    def result(self):
+        while self.pending:
+            self.next_ranks()
+        return np.array(self.ranks)
+
+
 def cal_ranks(scores, labels, filters):
+    # labels: dense [B, n_ent] 0/1 matrix, or (rows, cols) of the answers ordered by row then column
     scores = scores - np.min(scores, axis=1, keepdims=True) + 1e-8
     full_rank = rankdata(-scores, method='min', axis=1)
     filter_scores = scores * filters #
     filter_rank = rankdata(-filter_scores, method='min', axis=1)
+    if isinstance(labels, tuple):
+        return list((full_rank - filter_rank + 1)[labels])
     ranks = (full_rank - filter_rank + 1) * labels
     ranks = ranks[np.nonzero(ranks)]
     return list(ranks)
 
-def cal_performance(ranks,num):
+def count_ranks(scores, labels, filters, chunk=1 << 22):
+    # the ranks of cal_ranks by counting, for every answer, the unfiltered entities of its row scoring strictly
+    # higher: in torch on the device of `scores`, or in numpy; no sorting and no copy of the matrix to host
+    # scores: [B, n_ent] tensor or array, labels: (rows, cols) of the answers,
+    # filters: (rows, cols) of the known answers or a [B, n_ent] boolean mask, returns int64 ranks in label order
+    rows, cols = labels
+    on_device = isinstance(scores, torch.Tensor)
+    if on_device:
+        scores = scores.detach()
+        rows = torch.as_tensor(rows, device=scores.device)
+        cols = torch.as_tensor(cols, device=scores.device)
+    # same float ops as cal_ranks, so equal scores tie there iff they tie here
+    scores = scores - scores.min(1, keepdim=True)[0] + 1e-8 if on_device else \
+        scores - np.min(scores, axis=1, keepdims=True) + 1e-8
+    answers = scores[rows, cols]
+    if isinstance(filters, tuple):
+        if on_device:
+            mask = torch.zeros(scores.shape, dtype=torch.bool, device=scores.device)
+            mask[tuple(torch.as_tensor(f, device=scores.device) for f in filters)] = True
+        else:
+            mask = np.zeros(scores.shape, dtype=bool)
+            mask[filters] = True
+        filters = mask
+    # known answers never count, the answers themselves included
+    if on_device:
+        scores = scores.masked_fill(torch.as_tensor(filters, device=scores.device), -float('inf'))
+    else:
+        scores = np.where(filters, -np.inf, scores)
+    # [n_answer, n_ent] comparisons, in chunks of about `chunk` entries
+    step = max(1, chunk // scores.shape[1])
+    higher = [(scores[rows[i:i + step]] > answers[i:i + step, None]).sum(1) for i in range(0, len(rows), step)]
+    if on_device:
+        return (torch.cat(higher) + 1).cpu().numpy() if higher else np.zeros(0, dtype=np.int64)
+    return np.concatenate(higher) + 1 if higher else np.zeros(0, dtype=np.int64)
+
+def cal_ranks_sparse(scores, labels, filters, n_query, n_ent, default=0.):
+    # the ranks of cal_ranks without the dense [B, n_ent] matrices
+    # scores: (rows, cols, values) of the visited entities, every other entity scores `default`
+    # labels / filters: (rows, cols) of the answers / known answers, ordered by row then column
+    rows, cols, values = scores
+    # same float ops as cal_ranks, so equal scores tie there iff they tie here
+    n_visited = np.bincount(rows, minlength=n_query)
+    row_min = np.full(n_query, np.inf, dtype=values.dtype)
+    np.minimum.at(row_min, rows, values)
+    row_min = np.where(n_visited < n_ent, np.minimum(row_min, default), row_min).astype(values.dtype)
+    values = values - row_min[rows] + 1e-8
+    default = np.asarray(default, dtype=values.dtype) - row_min + 1e-8  # [n_query]
+
+    keys = rows.astype(np.int64) * n_ent + cols
+    order = np.argsort(keys, kind='stable')
+    keys, rows, values = keys[order], rows[order], values[order]
+    filter_keys = filters[0].astype(np.int64) * n_ent + filters[1]
+    filtered = np.isin(keys, filter_keys)
+
+    # scores of the answers, visited or not
+    label_rows = labels[0]
+    label_keys = label_rows.astype(np.int64) * n_ent + labels[1]
+    if len(keys) > 0:
+        pos = np.minimum(np.searchsorted(keys, label_keys), len(keys) - 1)
+        label_values = np.where(keys[pos] == label_keys, values[pos], default[label_rows])
+    else:
+        # nothing visited in the batch, every answer ranks against the default score alone
+        label_values = default[label_rows]
+
+    # rank = 1 + number of unfiltered entities of the row scoring strictly higher than the answer
+    # visited ones: count through (row, dense rank of the score) keys
+    free_rows, free_values = rows[~filtered], values[~filtered]
+    _, inv = np.unique(np.concatenate([free_values, label_values]), return_inverse=True)
+    n_rank = len(inv) + 1
+    free_keys = np.sort(free_rows.astype(np.int64) * n_rank + inv[:len(free_values)])
+    higher = (np.searchsorted(free_keys, (label_rows + 1).astype(np.int64) * n_rank, side='left')
+              - np.searchsorted(free_keys, label_rows.astype(np.int64) * n_rank + inv[len(free_values):],
+                                side='right'))
+    # unvisited ones: all share the default score
+    n_free_unvisited = (n_ent - n_visited - np.bincount(filters[0], minlength=n_query)
+                        + np.bincount(rows[filtered], minlength=n_query))
+    higher += np.where(default[label_rows] > label_values, n_free_unvisited[label_rows], 0)
+    return list(higher + 1)
+
+def rank_metrics(ranks, offsets, ks=(1, 3, 10, 50)):
+    # MRR, Hits@K and MAP@K for every K of ks in one pass over the flat ranks of all queries
+    # ranks: [N_answer], the answers of query q are ranks[offsets[q]:offsets[q + 1]]
+    # returns mrr, hits: [len(ks)], maps: [len(ks)]
+    ranks = np.asarray(ranks)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    ks = np.asarray(ks)
+    n_query = len(offsets) - 1
+    if not len(ranks):
+        return np.nan, np.full(len(ks), np.nan), np.zeros(len(ks))
     mrr = (1. / ranks).sum() / len(ranks)
-    h_1 = sum(ranks <= 1) * 1.0 / len(ranks)
-    h_3 = sum(ranks <= 3) * 1.0 / len(ranks)
-    h_10 = sum(ranks <= 10) * 1.0 / len(ranks)
-    h_50 = sum(ranks <= 50) * 1.0 / len(ranks)
-
-    def calculate_map(rank_list, K, num_list):
-        if not len(rank_list) :
-            return 0.0
-        import numpy as np
-
-        def calculate_ap(rankings, K):
-            """
-            Calculate AP@K for a single query.
-            This function assumes that `rankings` is a list of the ranks of the relevant items.
-            It sorts `rankings`, removes duplicates, and then computes the average precision.
-            """
-            unique_rankings = np.sort(np.unique(rankings))
-
-            ap_sum = 0.0
-            num_hits = 0
-            total_relevant = len(unique_rankings)
-
-            for i, rank in enumerate(unique_rankings):
-                if rank <= K:
-                    num_hits += 1
-                    precision_at_i = num_hits / (i + 1)
-                    ap_sum += precision_at_i
-
-            return ap_sum / total_relevant if total_relevant > 0 else 0.0
-
-        start_index = 0
-        ap_values = []
-
-        for num in num_list:
-            # Extract the relevant ranks for this query
-            relevant_ranks = rank_list[start_index:start_index + num]
-            # Calculate AP for this query
-            ap = calculate_ap(relevant_ranks, K)
-            ap_values.append(ap)
-            # Update the start index for the next query
-            start_index += num
-
-        # Calculate the mean of all AP values (MAP)
-        mean_ap = sum(ap_values) / len(ap_values) if ap_values else 0.0
-        return mean_ap
-
-    map_1 = calculate_map(ranks, 1,num)
-    map_3 = calculate_map(ranks, 3,num)
-    map_10 = calculate_map(ranks, 10,num)
-    map_50 = calculate_map(ranks, 50,num)
+    hits = (ranks[None, :] <= ks[:, None]).sum(1) * 1.0 / len(ranks)
+
+    # AP@K of a query over its distinct ranks r_1 < r_2 < ...: the i-th is a hit with precision i / i = 1
+    # iff r_i <= K, so AP@K = (distinct ranks <= K) / (distinct ranks)
+    query = np.repeat(np.arange(n_query), np.diff(offsets))
+    order = np.lexsort((ranks, query))
+    query, sorted_ranks = query[order], ranks[order]
+    first = np.ones(len(ranks), dtype=bool)
+    first[1:] = (query[1:] != query[:-1]) | (sorted_ranks[1:] != sorted_ranks[:-1])
+    query, sorted_ranks = query[first], sorted_ranks[first]
+    n_distinct = np.bincount(query, minlength=n_query)
+    n_hit = np.stack([np.bincount(query, weights=sorted_ranks <= k, minlength=n_query) for k in ks])
+    ap = np.where(n_distinct > 0, n_hit / np.maximum(n_distinct, 1), 0.)
+    # summed query by query like the per-query loop it replaces, so the means match it to the last bit
+    maps = np.cumsum(ap, axis=1)[:, -1] / n_query if n_query else np.zeros(len(ks))
+    return mrr, hits, maps
+
+def stratified_sample(strata, size, seed=0):
+    # `size` of the indices of strata drawn without replacement, split over the strata in proportion
+    # to their sizes (largest remainders), returned sorted
+    strata = np.asarray(strata)
+    if size >= len(strata):
+        return np.arange(len(strata))
+    rng = np.random.RandomState(seed)
+    _, inverse, counts = np.unique(strata, return_inverse=True, return_counts=True)
+    quota = counts * size / len(strata)
+    take = np.floor(quota).astype(np.int64)
+    take[np.argsort(take - quota, kind='stable')[:size - take.sum()]] += 1
+    # members grouped by stratum in random order, the first take[s] of every stratum are kept
+    order = np.lexsort((rng.rand(len(strata)), inverse))
+    position = np.arange(len(strata)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return np.sort(order[position < np.repeat(take, counts)])
+
+def bootstrap_metrics(ranks, offsets, strata=None, ks=(1, 3, 10, 50), n_boot=1000, confidence=0.95, seed=0):
+    # MRR and Hits@K with percentile bootstrap intervals, queries resampled with replacement within their strata
+    # ranks / offsets: as in rank_metrics, strata: [N_query] or None
+    # returns point, low, high: [1 + len(ks)] with MRR first
+    ranks = np.asarray(ranks, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n_query = len(offsets) - 1
+    query = np.repeat(np.arange(n_query), np.diff(offsets))
+    # per query: answers, summed reciprocal ranks and hits at every K; [2 + len(ks), N_query]
+    stats = [np.ones_like(ranks), 1. / ranks] + [ranks <= k for k in ks]
+    per_query = np.stack([np.bincount(query, weights=s, minlength=n_query) for s in stats])
+    point = per_query[1:].sum(1) / per_query[0].sum()
+
+    strata = np.zeros(n_query) if strata is None else np.asarray(strata)
+    _, inverse = np.unique(strata, return_inverse=True)
+    rng = np.random.RandomState(seed)
+    # [n_boot, N_query] draws, each stratum resampled from its own queries
+    draws = np.concatenate([members[rng.randint(0, len(members), (n_boot, len(members)))]
+                            for members in np.split(np.argsort(inverse, kind='stable'),
+                                                    np.cumsum(np.bincount(inverse))[:-1])], 1)
+    weights = np.bincount((np.arange(n_boot)[:, None] * n_query + draws).ravel(),
+                          minlength=n_boot * n_query).reshape(n_boot, n_query)
+    boot = weights @ per_query.T
+    low, high = np.quantile(boot[:, 1:] / boot[:, :1], [(1 - confidence) / 2, (1 + confidence) / 2], axis=0)
+    return point, low, high
+
+def cal_performance(ranks,num):
+    # num: answers per query, ranks grouped by query in the same order
+    mrr, hits, maps = rank_metrics(ranks, np.concatenate([[0], np.cumsum(num, dtype=np.int64)]))
+    h_1, h_3, h_10, h_50 = hits
+    map_1, map_3, map_10, map_50 = maps
     return mrr, h_1, h_3, h_10, h_50, map_1, map_3, map_10, map_50
 
 